@@ -0,0 +1,511 @@
+#!/usr/bin/env python
+"""
+Timings for taxtastic operations on large synthetic taxonomies
+
+Run a benchmark with:
+    python devtools/benchmarks.py <benchmark> [-n NODES]
+
+Use ``python devtools/benchmarks.py -h`` to list the available benchmarks.
+"""
+
+import argparse
+import contextlib
+from cStringIO import StringIO
+import csv
+import gc
+import logging
+import random
+import resource
+import sqlite3
+import sys
+import tempfile
+import time
+
+from Bio import Phylo
+from Bio.Phylo.BaseTree import Clade, Tree
+from sqlalchemy import create_engine
+
+from taxtastic import algotax, coltable, lonely, ncbi, taxdb
+from taxtastic.taxonomy import Taxonomy
+from taxtastic.taxtable import TaxNode
+
+RANKS = ['root', 'superkingdom', 'phylum', 'class', 'order', 'family',
+         'genus', 'species']
+
+
+@contextlib.contextmanager
+def timed(label):
+    start = time.time()
+    yield
+    print '{0:<40} {1:8.3f}s'.format(label, time.time() - start)
+
+
+def synthetic_tree(n, seed=1):
+    """
+    Build a TaxNode tree with (about) *n* nodes spread over ``RANKS``, each
+    rank having roughly three times as many nodes as the rank above it.
+    """
+    rng = random.Random(seed)
+    root = TaxNode('root', '1', name='root')
+    root.ranks = RANKS
+    weights = [3 ** i for i in range(1, len(RANKS))]
+    counts = [max(1, n * w // sum(weights)) for w in weights]
+    level = [root]
+    next_id = 2
+    for rank, count in zip(RANKS[1:], counts):
+        new_level = []
+        for _ in xrange(count):
+            node = TaxNode(rank, str(next_id),
+                           name='{0} {1}'.format(rank, next_id))
+            rng.choice(level).add_child(node)
+            new_level.append(node)
+            next_id += 1
+        level = new_level
+    return root
+
+
+def write_taxtable(root, path):
+    with open(path, 'w') as fp:
+        root.write_taxtable(fp)
+
+
+def bench_columnar(args):
+    """Load a taxtable from CSV and from the columnar format"""
+    root = synthetic_tree(args.nodes)
+    with tempfile.NamedTemporaryFile(suffix='.csv') as csv_tf, \
+            tempfile.NamedTemporaryFile(suffix='.taxcol') as col_tf:
+        with timed('write csv ({0} rows)'.format(len(root.index))):
+            write_taxtable(root, csv_tf.name)
+        with timed('write columnar'):
+            with open(col_tf.name, 'wb') as fp:
+                root.write_columnar(fp)
+
+        with timed('csv.DictReader'):
+            with open(csv_tf.name) as fp:
+                rows = list(csv.DictReader(fp))
+        with timed('coltable.read'):
+            with open(col_tf.name, 'rb') as fp:
+                table = coltable.read(fp)
+        assert len(rows) == len(table)
+
+        with timed('Taxdb.insert_from_taxtable (csv)'):
+            with open(csv_tf.name) as fp:
+                reader = csv.DictReader(fp)
+                db = taxdb.Taxdb()
+                db.create_tables()
+                db.insert_from_taxtable(lambda: reader._fieldnames, reader)
+        with timed('Taxdb.insert_from_columnar'):
+            with open(col_tf.name, 'rb') as fp:
+                db = taxdb.Taxdb()
+                db.create_tables()
+                db.insert_from_columnar(coltable.read(fp))
+
+        with timed('TaxNode.from_columnar'):
+            with open(col_tf.name, 'rb') as fp:
+                TaxNode.from_columnar(fp)
+        if not args.skip_slow:
+            with timed('TaxNode.from_taxtable'):
+                with open(csv_tf.name) as fp:
+                    TaxNode.from_taxtable(fp)
+
+
+def bench_taxdb_insert(args):
+    """Load a CSV taxtable into a Taxdb (use -n 2500000 for NCBI scale)"""
+    root = synthetic_tree(args.nodes)
+    with tempfile.NamedTemporaryFile(suffix='.csv') as csv_tf, \
+            tempfile.NamedTemporaryFile(suffix='.db') as db_tf:
+        write_taxtable(root, csv_tf.name)
+        del root
+        with open(csv_tf.name) as fp:
+            reader = csv.DictReader(fp)
+            rows = list(reader)
+        gc.collect()
+        with timed('insert_from_taxtable ({0} rows)'.format(len(rows))):
+            db = taxdb.Taxdb(sqlite3.connect(db_tf.name))
+            db.create_tables()
+            db.insert_from_taxtable(lambda: reader.fieldnames, rows)
+
+
+def bench_write_taxtable(args):
+    """Write a CSV taxtable and look up the genus of every node"""
+    root = synthetic_tree(args.nodes)
+    with tempfile.NamedTemporaryFile(suffix='.csv') as tf:
+        with timed('write_taxtable ({0} nodes)'.format(len(root.index))):
+            write_taxtable(root, tf.name)
+    with timed('at_rank for every node'):
+        for node in root:
+            try:
+                node.at_rank('genus')
+            except KeyError:
+                pass
+    with timed('ancestors_at_rank'):
+        root.ancestors_at_rank('genus')
+
+    root = node = TaxNode('root', '0', name='root')
+    root.ranks = RANKS
+    for i in xrange(1, 5000):
+        child = TaxNode('species', str(i), name=str(i))
+        node.add_child(child)
+        node = child
+    with tempfile.NamedTemporaryFile(suffix='.csv') as tf:
+        with timed('write_taxtable (5000 level chain)'):
+            write_taxtable(root, tf.name)
+
+
+def bench_from_taxtable(args):
+    """Load a TaxNode tree from a CSV taxtable"""
+    root = synthetic_tree(args.nodes)
+    with tempfile.NamedTemporaryFile(suffix='.csv') as tf:
+        write_taxtable(root, tf.name)
+        with timed('TaxNode.from_taxtable ({0} rows)'.format(len(root.index))):
+            with open(tf.name) as fp:
+                TaxNode.from_taxtable(fp)
+
+
+def bench_lonely(args):
+    """Load a lonely.Tree from a CSV taxtable and find its lonely nodes"""
+    root = synthetic_tree(args.nodes)
+    with tempfile.NamedTemporaryFile(suffix='.csv') as tf:
+        write_taxtable(root, tf.name)
+        with timed('taxtable_to_tree ({0} rows)'.format(len(root.index))):
+            with open(tf.name) as fp:
+                tree = lonely.taxtable_to_tree(fp)
+    with timed('lonelynodes'):
+        tree.lonelynodes()
+    nodes = tree.descendents.values()
+    with timed('read key, parent, children, rank x 10'):
+        for _ in xrange(10):
+            for node in nodes:
+                node.key, node.parent, node.children, node.rank
+
+
+def synthetic_ncbi_db(path, genera, species):
+    """
+    Create an NCBI taxonomy database at *path* with a single family of
+    *genera* genera. The first genus, tax_id ``g0``, has *species* species;
+    the others have ten each.
+    """
+    con = ncbi.db_connect(path)
+    nodes = [('1', '1', 'root')]
+    for i, rank in enumerate(['superkingdom', 'phylum', 'class', 'order',
+                              'family']):
+        nodes.append((str(i + 2), str(i + 1), rank))
+    for g in xrange(genera):
+        nodes.append(('g{0}'.format(g), '6', 'genus'))
+        for s in xrange(species if g == 0 else 10):
+            nodes.append(('g{0}s{1}'.format(g, s), 'g{0}'.format(g),
+                          'species'))
+    con.executemany("INSERT INTO nodes (tax_id, parent_id, rank) "
+                    "VALUES (?, ?, ?)", nodes)
+    con.executemany("INSERT INTO names (tax_id, tax_name, is_primary) "
+                    "VALUES (?, ?, 1)", ((n[0], 'name ' + n[0]) for n in nodes))
+    con.commit()
+    con.close()
+
+
+def bench_nary_subtree(args):
+    """Taxonomy.children_of, nary_subtree and species_below on a big genus"""
+    species = max(args.nodes // 100, 2)
+    with tempfile.NamedTemporaryFile(suffix='.db') as tf:
+        synthetic_ncbi_db(tf.name, 100, species)
+        engine = create_engine('sqlite:///' + tf.name)
+        genera = ['g{0}'.format(g) for g in xrange(100)]
+        with timed('children_of (genus, {0} species)'.format(species)):
+            Taxonomy(engine, ncbi.ranks).children_of('g0', species)
+        with timed('nary_subtree (every genus)'):
+            tax = Taxonomy(engine, ncbi.ranks)
+            for g in genera:
+                tax.nary_subtree(g)
+        with timed('nary_subtree (family)'):
+            Taxonomy(engine, ncbi.ranks).nary_subtree('6')
+        with timed('species_below (every genus)'):
+            tax = Taxonomy(engine, ncbi.ranks)
+            for g in genera:
+                tax.species_below(g)
+        engine.dispose()
+
+
+def bench_deep_tree(args):
+    """Traverse a caterpillar tree with one node per level"""
+    root = node = TaxNode('root', '0')
+    root.ranks = RANKS
+    for i in xrange(1, args.nodes):
+        child = TaxNode('species', str(i))
+        node.add_child(child)
+        node = child
+    with timed('pre-order ({0} levels)'.format(args.nodes)):
+        sum(1 for _ in root.depth_first_iter())
+    with timed('post-order'):
+        sum(1 for _ in root.depth_first_iter(self_first=False))
+    with timed('lineage of deepest node'):
+        node.lineage()
+
+
+def bench_prune(args):
+    """Prune a tree to the lineages of 1% of its species"""
+    root = synthetic_tree(args.nodes)
+    for node in root:
+        if node.rank == 'species' and int(node.tax_id) % 100 == 0:
+            node.sequence_ids.add(node.tax_id)
+    with timed('prune_unrepresented ({0} nodes)'.format(len(root.index))):
+        root.prune_unrepresented()
+    print '{0:<40} {1:8d}'.format('nodes remaining', len(root.index))
+
+    root = node = TaxNode('root', '0')
+    root.ranks = RANKS
+    for i in xrange(1, args.nodes):
+        child = TaxNode('species', str(i))
+        node.add_child(child)
+        node = child
+    with timed('prune chain ({0} levels)'.format(args.nodes)):
+        root.prune_unrepresented()
+
+
+def naive_mrca(nodes):
+    lineages = [node.lineage() for node in nodes]
+    common = None
+    for level in zip(*lineages):
+        if any(n is not level[0] for n in level):
+            break
+        common = level[0]
+    return common
+
+
+def bench_lca(args):
+    """Build an LCA index and answer MRCA queries"""
+    root = synthetic_tree(args.nodes)
+    with timed('lca_index ({0} nodes)'.format(len(root.index))):
+        index = root.lca_index()
+    rng = random.Random(1)
+    tax_ids = sorted(root.index)
+    pairs = [(rng.choice(tax_ids), rng.choice(tax_ids)) for _ in xrange(100000)]
+    with timed('mrca of 100000 pairs'):
+        for a, b in pairs:
+            index.mrca(a, b)
+    with timed('is_ancestor of 100000 pairs'):
+        for a, b in pairs:
+            index.is_ancestor(a, b)
+    sample = rng.sample(tax_ids, min(10000, len(tax_ids)))
+    with timed('mrca of {0} tax_ids'.format(len(sample))):
+        index.mrca(*sample)
+    if not args.skip_slow:
+        with timed('lineage intersection of 100000 pairs'):
+            for a, b in pairs:
+                naive_mrca([root.index[a], root.index[b]])
+
+
+# The trees drawn in tests/algotax_graphs/clade_coloring*.dot
+ALGOTAX_GRAPH_TREES = ['((A,A),(B,B))', '((A,B),((A,B),A))',
+                       '(((A,B),(C,D)),(A,B),(C,A))']
+
+
+def synthetic_colored_tree(n, colors, noise, max_children, seed=1):
+    """
+    Build a Bio.Phylo tree with *n* leaves named for one of *colors* colors,
+    assigned in contiguous blocks except for a fraction *noise* of leaves
+    colored at random, joining up to *max_children* adjacent subtrees at a
+    time.
+    """
+    rng = random.Random(seed)
+    nodes = []
+    for i in xrange(n):
+        color = i * colors // n
+        if rng.random() < noise:
+            color = rng.randrange(colors)
+        nodes.append(Clade(name='c{0}'.format(color)))
+    while len(nodes) > 1:
+        k = min(len(nodes), rng.randint(2, max_children))
+        i = rng.randrange(len(nodes) - k + 1)
+        nodes[i:i + k] = [Clade(clades=nodes[i:i + k])]
+    return Tree(root=nodes[0])
+
+
+def walk_tree(tree, **kwargs):
+    colors = {n: n.name for n in tree.get_terminals()}
+    metadata = algotax.color_clades(tree, colors)
+    return algotax.walk(tree.root, metadata, **kwargs)
+
+
+def bench_walk(args):
+    """Optimal convex subcoloring with algotax.walk (-n / 1000 leaves)"""
+    with timed('algotax_graphs trees (1000 times)'):
+        for _ in xrange(1000):
+            for newick in ALGOTAX_GRAPH_TREES:
+                walk_tree(Phylo.read(StringIO(newick), 'newick'))
+    leaves = max(args.nodes // 1000, 2)
+    for max_children in (2, 8):
+        tree = synthetic_colored_tree(leaves, 8, 0.2, max_children)
+        with timed('walk ({0} leaves, <= {1} children)'.format(
+                leaves, max_children)):
+            size = len(walk_tree(tree))
+        with timed('walk, max_states=16'):
+            capped = len(walk_tree(tree, max_states=16))
+        print '{0:<40} {1:8d} {2:8d}'.format('convex subset size (exact, capped)',
+                                             size, capped)
+
+    # A caterpillar, deeper than the recursion limit; Bio.Phylo's own
+    # traversals recurse, so leaves are collected while building it. A few
+    # leaves take the color of the next block down.
+    leaves = max(args.nodes // 2, 2)
+    rng = random.Random(1)
+    root = cur = Clade()
+    colors = {}
+    for i in xrange(leaves - 1):
+        color = i * 8 // leaves
+        if rng.random() < 0.01:
+            color = min(color + 1, 7)
+        leaf = Clade(name='c{0}'.format(color))
+        colors[leaf] = leaf.name
+        cur.clades = [leaf, Clade()]
+        cur = cur.clades[1]
+    cur.name = 'c7'
+    colors[cur] = cur.name
+    tree = Tree(root=root)
+    with timed('walk (caterpillar, {0} leaves)'.format(leaves)):
+        metadata = algotax.color_clades(tree, colors)
+        size = len(algotax.walk(root, metadata))
+    print '{0:<40} {1:8d}'.format('convex subset size', size)
+
+
+def bench_color_clades(args):
+    """Color the edges of multifurcating trees with algotax.color_clades"""
+    for max_children, colors, noise in ((2, 50, 0.2), (20, 200, 0.2),
+                                        (200, 1000, 0.2), (200, 1000, 0.8)):
+        tree = synthetic_colored_tree(args.nodes // 4, colors, noise,
+                                      max_children)
+        leaf_colors = {n: n.name for n in tree.get_terminals()}
+        with timed('color_clades (<= {0} children, {1} colors, {2})'.format(
+                max_children, colors, noise)):
+            algotax.color_clades(tree, leaf_colors)
+    rng = random.Random(1)
+    for fanout in (1000, 3000):
+        tree = Tree(root=Clade(clades=[
+            Clade(clades=[Clade(name='c{0}'.format(rng.randrange(300)))
+                          for _ in xrange(2)])
+            for _ in xrange(fanout)]))
+        leaf_colors = {n: n.name for n in tree.get_terminals()}
+        with timed('color_clades (root with {0} cherries)'.format(fanout)):
+            algotax.color_clades(tree, leaf_colors)
+
+
+def resident_bytes():
+    with open('/proc/self/statm') as fp:
+        return int(fp.read().split()[1]) * resource.getpagesize()
+
+
+def bench_seqinfo(args):
+    """Populate sequence ids from a seq_info file with 10 rows per node"""
+    root = synthetic_tree(args.nodes)
+    tax_ids = sorted(root.index)
+    rng = random.Random(1)
+    with tempfile.NamedTemporaryFile(suffix='.csv') as tf:
+        w = csv.writer(tf)
+        w.writerow(['seqname', 'accession', 'description', 'tax_id'])
+        for i in xrange(10 * len(tax_ids)):
+            w.writerow(['s{0}'.format(i), 'a{0}'.format(i), 'description',
+                        rng.choice(tax_ids) if i % 1000 else 'unknown'])
+        tf.flush()
+
+        if not args.skip_slow:
+            with timed('csv.DictReader ({0} rows)'.format(10 * len(tax_ids))):
+                with open(tf.name) as fp:
+                    for row in csv.DictReader(fp):
+                        node = root.index.get(row['tax_id'])
+                        if node:
+                            node.sequence_ids.add(row['seqname'])
+            for node in root:
+                node.sequence_ids = None
+        for compact in (False, True):
+            gc.collect()
+            before = resident_bytes()
+            with timed('populate_from_seqinfo compact={0}'.format(compact)):
+                with open(tf.name) as fp:
+                    root.populate_from_seqinfo(fp, compact=compact)
+            gc.collect()
+            print '{0:<40} {1:8.1f} MB'.format(
+                'sequence id memory', (resident_bytes() - before) / 1e6)
+            for node in root:
+                node.sequence_ids = None
+
+
+def bench_memory(args):
+    """Resident memory per TaxNode in a synthetic tree"""
+    gc.collect()
+    before = resident_bytes()
+    with timed('build tree ({0} nodes)'.format(args.nodes)):
+        root = synthetic_tree(args.nodes)
+    gc.collect()
+    used = resident_bytes() - before
+    print '{0:<40} {1:8.1f} bytes'.format('memory per node',
+                                          float(used) / len(root.index))
+
+
+def synthetic_taxdb(root, path=':memory:'):
+    """
+    Load a TaxNode tree into a database with the nodes and names tables of a
+    taxonomy database.
+    """
+    con = sqlite3.connect(path)
+    con.executescript("""
+        CREATE TABLE nodes (tax_id TEXT PRIMARY KEY NOT NULL,
+                            parent_id TEXT, rank TEXT);
+        CREATE INDEX nodes_parent_id ON nodes (parent_id);
+        CREATE TABLE names (tax_id TEXT, tax_name TEXT, is_primary INTEGER);
+        CREATE INDEX names_taxid_is_primary ON names (tax_id, is_primary);
+    """)
+    con.executemany("INSERT INTO nodes VALUES (?, ?, ?)",
+        ((n.tax_id, n.parent.tax_id if n.parent else n.tax_id, n.rank)
+         for n in root))
+    con.executemany("INSERT INTO names VALUES (?, ?, 1)",
+        ((n.tax_id, n.name) for n in root))
+    con.commit()
+    return con
+
+
+def bench_from_taxdb(args):
+    """Load a TaxNode tree from a taxonomy database"""
+    root = synthetic_tree(args.nodes)
+    tf = tempfile.NamedTemporaryFile(suffix='.db')
+    con = synthetic_taxdb(root, tf.name)
+    phylum = max((n for n in root if n.rank == 'phylum'),
+                 key=lambda n: sum(1 for _ in n))
+    with timed('from_taxdb root ({0} nodes)'.format(len(root.index))):
+        TaxNode.from_taxdb(con)
+    with timed('from_taxdb phylum ({0} nodes)'.format(
+            sum(1 for _ in phylum))):
+        TaxNode.from_taxdb(con, phylum.tax_id)
+
+
+BENCHMARKS = {
+    'color_clades': bench_color_clades,
+    'columnar': bench_columnar,
+    'deep_tree': bench_deep_tree,
+    'from_taxdb': bench_from_taxdb,
+    'from_taxtable': bench_from_taxtable,
+    'lca': bench_lca,
+    'lonely': bench_lonely,
+    'memory': bench_memory,
+    'nary_subtree': bench_nary_subtree,
+    'prune': bench_prune,
+    'seqinfo': bench_seqinfo,
+    'taxdb_insert': bench_taxdb_insert,
+    'walk': bench_walk,
+    'write_taxtable': bench_write_taxtable,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('benchmark', choices=sorted(BENCHMARKS),
+                        help='benchmark to run')
+    parser.add_argument('-n', '--nodes', type=int, default=200000,
+                        help='approximate number of nodes [%(default)s]')
+    parser.add_argument('--skip-slow', action='store_true', default=False,
+                        help='skip timings of slow reference implementations')
+    args = parser.parse_args()
+    logging.basicConfig()
+    BENCHMARKS[args.benchmark](args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
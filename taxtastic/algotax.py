@@ -14,17 +14,11 @@
 #    along with taxtastic.  If not, see <http://www.gnu.org/licenses/>.
 import collections
 import logging
-from itertools import combinations
+import operator
 
-log = logging.getLogger(__name__)
-
-def union(it):
-    "Take the union of an iterable of sets."
+from taxtastic.errors import NoAncestor
 
-    ret = set()
-    for x in it:
-        ret.update(x)
-    return ret
+log = logging.getLogger(__name__)
 
 def intersection(it):
     "Take the intersection of an iterable of sets."
@@ -37,6 +31,19 @@ def intersection(it):
             ret.intersection_update(x)
     return ret or set()
 
+def shared_colors(color_sets):
+    """
+    Return the set of colors found in at least two of *color_sets*.
+
+    This takes a single pass, keeping the colors seen once and those seen
+    twice, rather than intersecting every pair of sets.
+    """
+    once, twice = set(), set()
+    for colors in color_sets:
+        twice |= once & colors
+        once |= colors
+    return twice
+
 CladeMetadata = collections.namedtuple(
     'CladeMetadata', 'parents colors cut_colors')
 
@@ -68,8 +75,7 @@ def color_clades(tree, colors):
         node, okayed = stack.pop()
         if not node.clades:
             continue
-        okayed = union(cut_colors[a] & cut_colors[b]
-            for a, b in combinations(node.clades, 2)) | okayed
+        okayed = shared_colors(cut_colors[e] for e in node.clades) | okayed
         for e in node.clades:
             e_ = cut_colors[e] & okayed
             if e_ != cut_colors[e]:
@@ -78,8 +84,111 @@ def color_clades(tree, colors):
 
     return CladeMetadata(parents, colors, cut_colors)
 
-def walk(cur, metadata):
-    "Walk a biopython clade, determining the optimal convex subcoloring."
+# Partial solutions of `walk` are trees of tuples, so that combining two of
+# them takes constant time: ``(count, clade)`` for a single leaf, ``(count,
+# left, right)`` for the union of two disjoint solutions, and ``(0,)`` for the
+# empty solution. ``count`` is the number of leaves in the solution.
+EMPTY_SOLUTION = (0,)
+
+def join_solutions(a, b):
+    "Combine two disjoint partial solutions."
+    if not b[0]:
+        return a
+    if not a[0]:
+        return b
+    return (a[0] + b[0], a, b)
+
+def solution_nodes(solution):
+    "Return the set of leaves in a partial solution."
+    nodes = set()
+    stack = [solution]
+    while stack:
+        s = stack.pop()
+        if len(s) == 2:
+            nodes.add(s[1])
+        elif len(s) == 3:
+            stack.append(s[1])
+            stack.append(s[2])
+    return nodes
+
+# `_walk_node` doesn't prune the states of a node while combining its
+# children until there are more than this many.
+PRUNE_STATES_MIN = 16
+
+def prune_states(states, max_states=None):
+    """
+    Drop dominated states from *states*, a dict mapping a frozenset of used
+    colors to a partial solution.
+
+    A state is dominated by another whose colors are a subset of its own and
+    whose solution is at least as large: anything that can be added to the
+    first can be added to the second, with at least as good a result. If
+    *max_states* is given, only that many of the largest remaining states are
+    kept; the result may then no longer be optimal.
+    """
+    kept = []
+    # Kept states by number of colors; only those with fewer colors than a
+    # state can be proper subsets of it.
+    kept_by_len = collections.defaultdict(list)
+    for X in sorted(states, key=lambda X: (-states[X][0], len(X))):
+        n = len(X)
+        if not any(Y <= X for k, Ys in kept_by_len.iteritems() if k < n
+                   for Y in Ys):
+            kept.append(X)
+            kept_by_len[n].append(X)
+    if max_states is not None and len(kept) > max_states:
+        log.debug('keeping %d of %d states', max_states, len(kept))
+        del kept[max_states:]
+    return {X: states[X] for X in kept}
+
+def walk(cur, metadata, max_states=None):
+    """
+    Walk a biopython clade, determining the optimal convex subcoloring.
+
+    The children of each node are combined one at a time, keeping for each
+    set of used colors only the largest partial solution; dominated states
+    (see ``prune_states``) are dropped from the result for each node. Used
+    colors are only tracked while they can still conflict: within a node,
+    those cut by two of its children, and above it, those it cuts.
+    *max_states* bounds the number of states kept per color, at the cost of
+    optimality.
+
+    Partial solutions only carry their size and how they were put together;
+    the sets of nodes are built once, for *cur*. Nodes are visited in
+    post-order from an explicit stack, so the depth of the tree is not
+    limited by the recursion limit.
+
+    For the root, returns the largest set of nodes. For any other clade,
+    returns a dict mapping each color cut by the clade (or None) to a dict
+    mapping sets of used colors to sets of nodes.
+    """
+
+    parents = metadata.parents
+    results = {}
+    stack = [(cur, False)]
+    while stack:
+        node, expanded = stack.pop()
+        if node.clades and not expanded:
+            stack.append((node, True))
+            stack.extend((child, False) for child in node.clades)
+            continue
+        # Each child's states are only needed by its parent.
+        phi = [results.pop(child) for child in node.clades]
+        results[node] = _walk_node(node, phi, metadata, max_states)
+
+    ret = results.pop(cur)
+    # If this is the parent node, return just the biggest set of nodes.
+    if parents[cur] is None:
+        return solution_nodes(ret[None][frozenset()])
+    return {c: {X: solution_nodes(solution)
+                for X, solution in states.iteritems()}
+            for c, states in ret.iteritems()}
+
+def _walk_node(cur, phi, metadata, max_states):
+    """
+    Compute the states of `walk` for *cur*, given *phi*, the states of each
+    of its children.
+    """
 
     parents, colors, cut_colors = metadata
 
@@ -97,58 +206,64 @@ def walk(cur, metadata):
         if K:
             color = colors[cur]
             assert len(K) == 1 and color in K
-            ret[color][frozenset([color])] = {cur}
-            ret[None][frozenset([color])] = {cur}
+            ret[color][frozenset([color])] = (1, cur)
+            ret[None][frozenset([color])] = (1, cur)
         else:
-            ret[None][frozenset()] = {cur}
+            ret[None][frozenset()] = (1, cur)
         return ret
 
-    phi = [walk(x, metadata) for x in cur.clades]
-    B = union(cut_colors[a] & cut_colors[b]
-        for a, b in combinations(cur.clades, 2))
+    B = shared_colors(cut_colors[x] for x in cur.clades)
+    # Only colors cut by two children can conflict while combining them, and
+    # only colors cut by `cur` can conflict further up the tree; states are
+    # keyed by their used colors restricted to these.
+    relevant = frozenset(B | K)
+    K_ = frozenset(K)
 
     for c in K | {None}:
-        ret_c = collections.defaultdict(list)
+        ret_c = {}
         for b in B | {c}:
-            def aux(phis, used_colors, accum):
-                # Base case; we've reached the end of the list.
-                if not phis:
-                    ret_c[frozenset(used_colors)].append(accum)
-                    return
-
-                phi_i, phi_rest = phis[0], phis[1:]
-                X_is = phi_i[b]
-
+            states = {frozenset(): EMPTY_SOLUTION}
+            # Dominated states are dropped whenever the number of states has
+            # doubled since they last were, which keeps wide nodes from
+            # accumulating them without pruning after every child.
+            prune_at = PRUNE_STATES_MIN
+            for phi_i in phi:
+                X_is = phi_i[b] or phi_i[None]
                 # One possible solution is to ignore this `phi` completely.
-                aux(phi_rest, used_colors, accum)
+                new_states = dict(states)
+                for used_colors, accum in states.iteritems():
+                    for X_i, T_i in X_is.iteritems():
+                        if (X_i & used_colors) - {b}:
+                            continue
+                        if b != c and c in X_i:
+                            continue
+                        # The children's node sets are disjoint, so only the
+                        # largest set for each combination of colors matters.
+                        X = (used_colors | X_i) & relevant
+                        best = new_states.get(X)
+                        if best is None or best[0] < accum[0] + T_i[0]:
+                            new_states[X] = join_solutions(accum, T_i)
+                states = new_states
+                if max_states is not None and len(states) > max_states:
+                    states = prune_states(states, max_states)
+                elif len(states) > prune_at:
+                    states = prune_states(states)
+                    prune_at = max(2 * len(states), PRUNE_STATES_MIN)
 
-                if not X_is:
-                    X_is = phi_i[None]
+            for X, T in states.iteritems():
+                X = X & K_
+                if X not in ret_c or ret_c[X][0] < T[0]:
+                    ret_c[X] = T
 
-                for X_i in X_is:
-                    if (X_i & used_colors) - {b}:
-                        continue
-                    if b != c and c in X_i:
-                        continue
-                    aux(phi_rest, used_colors | X_i, accum | X_is[X_i])
-
-            aux(phi, set(), set())
-
-        # For each `X_i`, the optimal `T_i` is the one with the most nodes in
-        # it.
-        ret[c] = {X_i: max(T_is, key=len) for X_i, T_is in ret_c.iteritems()}
+        ret[c] = prune_states(ret_c, max_states)
 
     # If there were no cut colors, the only relevant data is the biggest set of
     # nodes, so prune everything else out.
     if not K:
-        total = max(ret[None].itervalues(), key=len)
+        total = max(ret[None].itervalues(), key=operator.itemgetter(0))
         ret.clear()
         ret[None][frozenset()] = total
 
-    # If this is the parent node, return just the biggest set of nodes.
-    if parents[cur] is None:
-        return ret[None][frozenset()]
-
     return ret
 
 Ranking = collections.namedtuple('Ranking', 'rank node')
@@ -163,10 +278,28 @@ def reroot_from_rp(root, rp, ignore_missing_sequences=False):
         FROM   taxa
                JOIN ranks USING (rank)
     """))
+
+    # The MRCA of each clade, filled in children first: the MRCA of a clade
+    # is the MRCA of its children's MRCAs. Clades without any sequences in
+    # name_map map to None.
+    mrcas = {}
+    clades = [root]  # breadth-first, so parents precede their children
+    for clade in clades:
+        clades.extend(clade.clades)
+    for clade in reversed(clades):
+        if clade.clades:
+            ts = set(mrcas[c] for c in clade.clades)
+            ts.discard(None)
+        elif ignore_missing_sequences and clade.name not in name_map:
+            ts = ()
+        else:
+            ts = (name_map[clade.name],)
+        mrcas[clade] = rp.most_recent_common_ancestor(*ts) if ts else None
+
     def subrk_min(t):
-        mrca = rp.most_recent_common_ancestor(
-            *set(name_map[n.name] for n in t.get_terminals()
-                 if not ignore_missing_sequences or n.name in name_map))
+        mrca = mrcas[t]
+        if mrca is None:
+            raise NoAncestor()
         logging.debug("mrca for %r is %r", t, mrca)
         return rank_map[mrca]
 
@@ -0,0 +1,268 @@
+# This file is part of taxtastic.
+#
+#    taxtastic is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    taxtastic is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with taxtastic.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Compact columnar representation of taxtables.
+
+A columnar taxtable holds the same information as the CSV taxtables
+written by ``taxit taxtable``, stored as typed columns:
+
+ * ``tax_id`` - the tax_ids (string column)
+ * ``parent`` - row index of the parent of each row (int32); the root is
+   its own parent
+ * ``rank`` - index into the rank dictionary (uint16)
+ * ``tax_name`` - index into the ``names`` dictionary (int32)
+
+The per-rank lineage columns of the CSV format are not stored; they are
+reconstructed from the parent links when rows are read back.
+
+On disk, a file starts with ``MAGIC``, followed by the length of a JSON
+header as a little-endian uint32, the header itself, and then each
+column (zlib compressed) in the order listed in the header.
+
+Reading the columns takes a small fraction of the time needed to parse the
+equivalent CSV. Once rows are turned into ``TaxNode`` objects or inserted
+into a database, object creation or SQLite dominates, and the saving is
+much smaller (roughly 1.3 to 2 times).
+"""
+
+import array
+import json
+import struct
+import sys
+import zlib
+
+MAGIC = 'TAXCOL1\n'
+FORMAT_VERSION = 1
+
+_header_size = struct.Struct('<I')
+
+
+def _pack_strings(values):
+    # Missing values (e.g. the name of a root read from a taxonomy database)
+    # are written as empty strings, as in CSV taxtables.
+    return '\0'.join('' if v is None else v for v in values)
+
+
+def _unpack_strings(s, count):
+    if not count:
+        return []
+    return s.split('\0')
+
+
+def _pack_array(typecode, values):
+    a = array.array(typecode, values)
+    if sys.byteorder == 'big':
+        a.byteswap()
+    return a.tostring()
+
+
+def _unpack_array(typecode, s):
+    a = array.array(typecode)
+    a.fromstring(s)
+    if sys.byteorder == 'big':
+        a.byteswap()
+    return a
+
+
+def dictionary_encode(values, dictionary=None):
+    """
+    Encode *values* as indices into a list of distinct values.
+
+    Returns ``(dictionary, codes)``. If *dictionary* is given, it is used
+    (and extended) as the initial list of values.
+    """
+    dictionary = list(dictionary or [])
+    lookup = {v: i for i, v in enumerate(dictionary)}
+    codes = []
+    for v in values:
+        code = lookup.get(v)
+        if code is None:
+            code = lookup[v] = len(dictionary)
+            dictionary.append(v)
+        codes.append(code)
+    return dictionary, codes
+
+
+class ColumnarTaxtable(object):
+    """
+    A taxtable held as columns.
+
+    Rows can be iterated over as dictionaries with the same keys as those
+    produced by ``csv.DictReader`` on a CSV taxtable, so an instance can be
+    used wherever a CSV taxtable reader is expected.
+    """
+    base_fieldnames = ['tax_id', 'parent_id', 'rank', 'tax_name']
+
+    def __init__(self, ranks, tax_ids, parents, rank_values, rank_codes,
+                 names, name_codes):
+        self.ranks = list(ranks)
+        self.tax_ids = tax_ids
+        self.parents = parents
+        self.rank_values = rank_values
+        self.rank_codes = rank_codes
+        self.names = names
+        self.name_codes = name_codes
+        assert len(tax_ids) == len(parents) == len(rank_codes) == len(name_codes)
+
+    @property
+    def fieldnames(self):
+        return self.base_fieldnames + self.ranks
+
+    def __len__(self):
+        return len(self.tax_ids)
+
+    def rank(self, i):
+        return self.rank_values[self.rank_codes[i]]
+
+    def tax_name(self, i):
+        return self.names[self.name_codes[i]]
+
+    def parent_id(self, i):
+        return self.tax_ids[self.parents[i]]
+
+    def records(self):
+        """
+        Generate ``(tax_id, parent_id, rank, tax_name)`` for each row.
+        """
+        tax_ids, rank_values, names = self.tax_ids, self.rank_values, self.names
+        for tax_id, parent, rank, name in zip(
+                tax_ids, self.parents, self.rank_codes, self.name_codes):
+            yield tax_id, tax_ids[parent], rank_values[rank], names[name]
+
+    def lineages(self):
+        """
+        Generate a ``{rank: tax_id}`` dict for each row, including the row
+        itself and all of its ancestors.
+        """
+        parents, rank_codes, rank_values = \
+            self.parents, self.rank_codes, self.rank_values
+        memo = {}
+        for i in xrange(len(self)):
+            path = []
+            j = i
+            while j not in memo:
+                path.append(j)
+                p = parents[j]
+                if p == j:
+                    break
+                j = p
+            lineage = memo.get(j, {})
+            for j in reversed(path):
+                lineage = dict(lineage)
+                lineage[rank_values[rank_codes[j]]] = self.tax_ids[j]
+                memo[j] = lineage
+            yield memo[i]
+
+    def __iter__(self):
+        for record, lineage in zip(self.records(), self.lineages()):
+            d = dict.fromkeys(self.ranks, '')
+            d.update(lineage)
+            d.update(zip(self.base_fieldnames, record))
+            yield d
+
+    @classmethod
+    def from_records(cls, ranks, records):
+        """
+        Build a table from an iterable of ``(tax_id, parent_id, rank,
+        tax_name)``.
+        """
+        tax_ids, parent_ids, rank_names, names = [], [], [], []
+        for tax_id, parent_id, rank, tax_name in records:
+            tax_ids.append(tax_id)
+            parent_ids.append(parent_id)
+            rank_names.append(rank)
+            names.append(tax_name)
+
+        index = {t: i for i, t in enumerate(tax_ids)}
+        if len(index) != len(tax_ids):
+            raise ValueError('taxtable contains duplicate tax_ids')
+        try:
+            parents = array.array('i', [index[p] for p in parent_ids])
+        except KeyError, e:
+            raise ValueError(
+                'parent_id {0} not found in taxtable'.format(e.args[0]))
+
+        rank_values, rank_codes = dictionary_encode(rank_names, ranks)
+        names, name_codes = dictionary_encode(names)
+        return cls(ranks, tax_ids, parents, rank_values,
+                   array.array('H', rank_codes), names,
+                   array.array('i', name_codes))
+
+    def write(self, out_fp, compresslevel=6):
+        """
+        Write this table to the binary file object *out_fp*.
+        """
+        columns = [('tax_id', 'str', _pack_strings(self.tax_ids)),
+                   ('parent', 'i', _pack_array('i', self.parents)),
+                   ('rank', 'H', _pack_array('H', self.rank_codes)),
+                   ('tax_name', 'i', _pack_array('i', self.name_codes)),
+                   ('names', 'str', _pack_strings(self.names))]
+        counts = {'tax_id': len(self), 'names': len(self.names)}
+        columns = [(name, typecode, zlib.compress(data, compresslevel))
+                   for name, typecode, data in columns]
+        header = {'version': FORMAT_VERSION,
+                  'nrows': len(self),
+                  'ranks': self.ranks,
+                  'rank_values': self.rank_values,
+                  'columns': [{'name': name, 'type': typecode, 'size': len(data),
+                               'count': counts.get(name)}
+                              for name, typecode, data in columns]}
+        header = json.dumps(header)
+        out_fp.write(MAGIC)
+        out_fp.write(_header_size.pack(len(header)))
+        out_fp.write(header)
+        for _, _, data in columns:
+            out_fp.write(data)
+
+    @classmethod
+    def read(cls, fp):
+        """
+        Read a table written by :meth:`write` from the file object *fp*.
+        """
+        if fp.read(len(MAGIC)) != MAGIC:
+            raise ValueError('not a columnar taxtable')
+        size, = _header_size.unpack(fp.read(_header_size.size))
+        header = json.loads(fp.read(size))
+        if header['version'] != FORMAT_VERSION:
+            raise ValueError('unsupported columnar taxtable version: {0}'.format(
+                header['version']))
+
+        columns = {}
+        for column in header['columns']:
+            data = zlib.decompress(fp.read(column['size']))
+            if column['type'] == 'str':
+                columns[column['name']] = _unpack_strings(data, column['count'])
+            else:
+                columns[column['name']] = _unpack_array(column['type'], data)
+
+        ranks = [str(r) for r in header['ranks']]
+        rank_values = [str(r) for r in header['rank_values']]
+        return cls(ranks, columns['tax_id'], columns['parent'], rank_values,
+                   columns['rank'], columns['names'], columns['tax_name'])
+
+
+def read(fp):
+    """
+    Read a columnar taxtable. Shortcut for :meth:`ColumnarTaxtable.read`.
+    """
+    return ColumnarTaxtable.read(fp)
+
+
+def write(out_fp, ranks, records):
+    """
+    Write ``(tax_id, parent_id, rank, tax_name)`` *records* to *out_fp* as a
+    columnar taxtable with rank columns *ranks*.
+    """
+    ColumnarTaxtable.from_records(ranks, records).write(out_fp)
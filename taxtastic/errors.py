@@ -21,3 +21,6 @@ class OperationalError(sqlite3.OperationalError):
 
 class IntegrityError(sqlite3.IntegrityError):
     pass
+
+class NoAncestor(Exception):
+    pass
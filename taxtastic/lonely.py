@@ -1,73 +1,226 @@
 import csv
+import logging
+
+from sqlalchemy.sql import select
+
+from taxtastic.taxdb import batched
+from taxtastic.taxonomy import ranks_below
+
+log = logging.getLogger(__name__)
 
 class Tree(object):
-    """Tree for describing taxonomies."""
-    def __init__(self, key, **nodedata):
+    """Tree for describing taxonomies.
+
+    Nodes have explicit ``rank`` and ``tax_name`` fields; any other keyword
+    arguments are kept in ``data`` and can also be read as attributes.
+
+    The root of a tree keeps a single index of all of its nodes by key, which
+    is shared by the whole tree; see `descendents`.
+    """
+    __slots__ = ('key', 'rank', 'tax_name', 'data', 'parent', 'children',
+                 '_index')
+
+    def __init__(self, key, rank=None, tax_name=None, **nodedata):
         self.key = key
+        self.rank = rank
+        self.tax_name = tax_name
         self.data = nodedata
         self.parent = None
         self.children = []
-        self.descendents = {key: self}
+        self._index = None
     def __repr__(self, n=0):
-        return "  "*n + "Tree(%s" % self.key + "".join(', %s=%s' % (k,v) for k,v in self.data.iteritems()) + ")" + \
+        fields = [(k, v) for k, v in [('rank', self.rank),
+                                      ('tax_name', self.tax_name)]
+                  if v is not None]
+        fields.extend(self.data.iteritems())
+        return "  "*n + "Tree(%s" % self.key + "".join(', %s=%s' % (k,v) for k,v in fields) + ")" + \
             ("" if len(self.children) == 0 else "(\n" + ",\n".join(c.__repr__(n+1) for c in self.children) + ")") + ''
     def __call__(self, *children):
+        root = self.getroot()
+        index = root.descendents
         for c in children:
+            # Each child is the root of its own tree until now, with its own
+            # index; merge the smaller of the two indexes into the larger.
+            other = c.descendents
+            c._index = None
             c.parent = self
             self.children.append(c)
-            # When creating a tree a priori, the children are fully created
-            # before the parents are, so we have to add all
-            # descendents of the children to the parents when we
-            # finally get to them.
-            self.descendents.update(c.descendents)
-            # On the other hand, when adding children to an existing
-            # tree, we have to propogate them up all the descendents
-            # dictionaries of the parents.
-            q = self
-            while True:
-                q.descendents[c.key] = c
-                if q.isroot():
-                    break
-                else:
-                    q = q.parent
+            if len(other) > len(index):
+                index, other = other, index
+            index.update(other)
+        root._index = index
         return self
-    def __getattribute__(self, name):
-        if name == 'children':
-            return object.__getattribute__(self, 'children')
-        elif name in object.__getattribute__(self, 'data'):
-            return object.__getattribute__(self, 'data')[name]
-        else:
-            return object.__getattribute__(self, name)
+    def __getattr__(self, name):
+        # Only called when normal attribute lookup fails, so that the fields
+        # above are plain slot reads.
+        if name != 'data':
+            try:
+                return self.data[name]
+            except KeyError:
+                pass
+        raise AttributeError(name)
+    @property
+    def descendents(self):
+        """A dict of this node and all nodes below it, by key.
+
+        For the root this is the index kept up to date by `__call__`; for
+        other nodes it is built on each access.
+        """
+        if self.isroot():
+            if self._index is None:
+                self._index = {self.key: self}
+            return self._index
+        nodes = {}
+        stack = [self]
+        while stack:
+            node = stack.pop()
+            nodes[node.key] = node
+            stack.extend(node.children)
+        return nodes
     def isroot(self):
         return self.parent == self or self.parent is None
+    def getroot(self):
+        node = self
+        while not node.isroot():
+            node = node.parent
+        return node
     def lonelynodes(self):
         return [x for x in self.descendents.itervalues()
                 if x.parent is not None and len(x.parent.children) == 1]
 
 
 def taxtable_to_tree(handle):
-    """Read a CSV taxonomy from *handle* into a Tree."""
+    """Read a CSV taxonomy from *handle* into a Tree.
+
+    Parents must precede their children, as in taxtables written by ``taxit
+    taxtable``. Nodes are linked directly and added to the root's index, so
+    this takes time linear in the number of rows.
+    """
     c = csv.reader(handle, quoting=csv.QUOTE_NONNUMERIC)
     header = c.next()
-    rootdict = dict(zip(header, c.next()))
-    t = Tree(rootdict['tax_id'], rank=rootdict['rank'], tax_name=rootdict['tax_name'])
+    tax_id, parent_id, rank, tax_name = (
+        header.index(k) for k in ('tax_id', 'parent_id', 'rank', 'tax_name'))
+    l = c.next()
+    t = Tree(l[tax_id], rank=l[rank], tax_name=l[tax_name])
+    index = t.descendents
     for l in c:
-        d = dict(zip(header, l))
-        target = t.descendents[d['parent_id']]
-        target(Tree(d['tax_id'], rank=d['rank'], tax_name=d['tax_name']))
+        node = Tree(l[tax_id], rank=l[rank], tax_name=l[tax_name])
+        parent = index[l[parent_id]]
+        node.parent = parent
+        parent.children.append(node)
+        index[node.key] = node
     return t
 
+class _Neighborhood(object):
+    """The ranks and children of the taxa near some tax_ids in a Taxonomy.
+
+    Nodes are fetched as needed, with one query per batch of tax_ids rather
+    than several per tax_id, and queries are then answered in memory as
+    ``Taxonomy`` would answer them.
+    """
+    # Keep well below SQLite's limit on the number of query parameters.
+    batch_size = 500
+
+    def __init__(self, taxonomy, tax_ids):
+        self.nodes = taxonomy.nodes
+        self.parents = {}
+        self.ranks = {}
+        self.children = {}
+        tax_ids = set(t for t in tax_ids if t is not None)
+        for tax_id, parent_id, rank in self._fetch(self.nodes.c.tax_id, tax_ids):
+            self.parents[tax_id] = parent_id
+            self.ranks[tax_id] = rank
+        for t in tax_ids:
+            if t not in self.parents:
+                raise KeyError('value "%s" not found in nodes.tax_id' % t)
+        self.fetch_children(self.parents[t] for t in tax_ids)
+
+    def _fetch(self, column, values):
+        nodes = self.nodes
+        for batch in batched(values, self.batch_size):
+            s = select([nodes.c.tax_id, nodes.c.parent_id, nodes.c.rank],
+                       column.in_(batch))
+            for row in s.execute():
+                yield row
+
+    def fetch_children(self, tax_ids):
+        """Fetch the children of those of *tax_ids* not already known."""
+        new = set(t for t in tax_ids if t not in self.children)
+        for t in new:
+            self.children[t] = []
+        for tax_id, parent_id, rank in self._fetch(self.nodes.c.parent_id, new):
+            if tax_id != parent_id:
+                self.parents[tax_id] = parent_id
+                self.ranks[tax_id] = rank
+                self.children[parent_id].append(tax_id)
+
+    def sibling_of(self, tax_id):
+        """As ``Taxonomy.sibling_of``."""
+        if tax_id is None:
+            return None
+        rank = self.ranks[tax_id]
+        for c in self.children[self.parents[tax_id]]:
+            if c != tax_id and self.ranks[c] == rank:
+                return c
+        log.warning('No sibling of tax_id %s with rank %s found in taxonomy' % (tax_id, rank))
+        return None
+
+    def children_of(self, tax_id, n):
+        """As ``Taxonomy.children_of``; the children must have been fetched."""
+        # Any child will do below ranks that `ranks_below` doesn't know.
+        below = ranks_below(self.ranks[tax_id])
+        return [c for c in self.children[tax_id]
+                if not below or self.ranks[c] in below][:n]
+
+    def descend(self, tax_ids, n):
+        """
+        Fetch the subtrees below *tax_ids* that ``species_below`` (*n* = 1)
+        or ``nary_subtree`` (*n* = 2) visit, one level per query.
+        """
+        frontier = [t for t in tax_ids
+                    if t is not None and self.ranks[t] != 'species']
+        while frontier:
+            self.fetch_children(frontier)
+            frontier = [c for t in frontier for c in self.children_of(t, n)
+                        if self.ranks[c] != 'species']
+
+    def species_below(self, tax_id):
+        """As ``Taxonomy.species_below``; see `descend`."""
+        while tax_id is not None and self.ranks[tax_id] != 'species':
+            children = self.children_of(tax_id, 1)
+            if not children:
+                log.warning("No children of tax_id %s with rank below %s found in database" % (tax_id, self.ranks[tax_id]))
+                return None
+            tax_id = children[0]
+        return tax_id
+
+    def nary_subtree(self, tax_id, n=2):
+        """As ``Taxonomy.nary_subtree``; see `descend`."""
+        if tax_id is None:
+            return None
+        if self.ranks[tax_id] == 'species':
+            return [tax_id]
+        species_taxids = []
+        for t in self.children_of(tax_id, n):
+            species_taxids.extend(self.nary_subtree(t, n))
+        return species_taxids
+
 def lonely_company(taxonomy, tax_ids):
     """Return a set of species tax_ids which will makes those in *tax_ids* not lonely.
 
     The returned species will probably themselves be lonely.
     """
-    return [taxonomy.species_below(taxonomy.sibling_of(t)) for t in tax_ids]
+    taxa = _Neighborhood(taxonomy, tax_ids)
+    siblings = [taxa.sibling_of(t) for t in tax_ids]
+    taxa.descend(siblings, 1)
+    return [taxa.species_below(t) for t in siblings]
 
 def solid_company(taxonomy, tax_ids):
     """Return a set of non-lonely species tax_ids that will make those in *tax_ids* not lonely."""
+    taxa = _Neighborhood(taxonomy, tax_ids)
+    siblings = [taxa.sibling_of(t) for t in tax_ids]
+    taxa.descend(siblings, 2)
     res = []
-    for t in tax_ids:
-        res.extend(taxonomy.nary_subtree(taxonomy.sibling_of(t), 2) or [])
+    for t in siblings:
+        res.extend(taxa.nary_subtree(t, 2) or [])
     return res
-
@@ -28,7 +28,9 @@ import hashlib
 import shutil
 import os
 import copy
+import re
 import json
+import sqlite3
 import time
 import csv
 import errno
@@ -38,10 +40,28 @@ import zipfile
 import Bio.SeqIO
 import Bio.Phylo
 
-from taxtastic import utils, taxdb
+from taxtastic import algotax, utils, taxdb, taxtable
+# Raised by algotax too; still available as refpkg.NoAncestor
+from taxtastic.errors import NoAncestor
 
 FORMAT_VERSION = '1.1'
 
+# Bump when the schema or contents of the databases built by
+# Refpkg.load_db change, so that stale cached copies are ignored.
+TAXDB_CACHE_VERSION = '3'
+
+# Refpkg.load_db keeps only this many of the most recently written databases
+# in the cache directory.
+TAXDB_CACHE_SIZE = 10
+
+# Temporary files left in the cache directory by an interrupted load_db are
+# removed once they are this many seconds old.
+TAXDB_CACHE_TMP_AGE = 24 * 60 * 60
+
+# Names of the databases written by Refpkg.load_db, and of its temporary files
+_CACHE_DB_RE = re.compile(r'^[0-9a-f]{32}\.db$')
+_CACHE_TMP_RE = re.compile(r'^[0-9a-f]{32}.*\.tmp$')
+
 def md5file(fobj):
     md5 = hashlib.md5()
     for block in iter(lambda: fobj.read(4096), ''):
@@ -70,6 +90,73 @@ def scratch_file(unlink=True, **kwargs):
             os.unlink(tmp_name)
 
 
+def default_cache_dir():
+    """
+    Return the directory holding cached taxonomy databases:
+    ``$TAXTASTIC_CACHE_DIR`` if set, else ``$XDG_CACHE_HOME/taxtastic``, or
+    ``~/.cache/taxtastic``.
+    """
+    if os.environ.get('TAXTASTIC_CACHE_DIR'):
+        return os.environ['TAXTASTIC_CACHE_DIR']
+    base = os.environ.get('XDG_CACHE_HOME') or \
+        os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(base, 'taxtastic')
+
+
+def _prune_cache(cache_dir, keep=None):
+    """
+    Remove all but the *keep* (default: ``TAXDB_CACHE_SIZE``) most recently
+    written databases from *cache_dir*, along with temporary files older than
+    ``TAXDB_CACHE_TMP_AGE``. Files not written by ``Refpkg.load_db`` are left
+    alone.
+    """
+    keep = TAXDB_CACHE_SIZE if keep is None else keep
+    now = time.time()
+    dbs, stale = [], []
+    for name in os.listdir(cache_dir):
+        path = os.path.join(cache_dir, name)
+        try:
+            mtime = os.path.getmtime(path)
+        except OSError:
+            # Removed by a concurrent loader
+            continue
+        if _CACHE_DB_RE.match(name):
+            dbs.append((mtime, path))
+        elif _CACHE_TMP_RE.match(name) and now - mtime > TAXDB_CACHE_TMP_AGE:
+            stale.append(path)
+    dbs.sort(reverse=True)
+    for path in [path for _, path in dbs[keep:]] + stale:
+        try:
+            os.unlink(path)
+        except OSError:
+            # Already removed; the cache is only an optimization.
+            pass
+
+
+def _open_cached_db(path):
+    """
+    Return the cached database at *path* as a Taxdb, or None if it is missing
+    or incomplete.
+    """
+    if not os.path.exists(path):
+        return None
+    # The file may be removed by a concurrent loader before it is opened,
+    # leaving an empty database, so check for the tables.
+    try:
+        con = sqlite3.connect(path)
+        tables = set(name for name, in con.execute("""
+            SELECT name
+            FROM   sqlite_master
+            WHERE  type = 'table'
+        """))
+    except sqlite3.DatabaseError:
+        return None
+    if not tables >= set(['taxa', 'sequences']):
+        con.close()
+        return None
+    return taxdb.Taxdb(con)
+
+
 def manifest_template():
     return {'metadata': {'create_date': time.strftime('%Y-%m-%d %H:%M:%S'),
                          'format_version': FORMAT_VERSION},
@@ -132,9 +219,6 @@ def transaction(f, self, *args, **kwargs):
             self.current_transaction = None
 
 
-class NoAncestor(Exception):
-    pass
-
 class Refpkg(object):
     _manifest_name = 'CONTENTS.json'
 
@@ -176,6 +260,8 @@ class Refpkg(object):
         self._set_defaults()
 
         self.db = None
+        # (taxonomy md5, LCAIndex) built by lca_index
+        self._lca_index = None
 
     def _install_zipfile_handlers(self):
         self._archive = zipfile.ZipFile(self.path)
@@ -454,7 +540,7 @@ class Refpkg(object):
         return old_path
 
     @transaction
-    def reroot(self, rppr=None, pretend=False):
+    def reroot(self, rppr=None, pretend=False, native=False):
         """Reroot the phylogenetic tree.
 
         This operation calls ``rppr reroot`` to generate the rerooted
@@ -463,17 +549,37 @@ class Refpkg(object):
         specify the path to ``rppr`` by giving it as the *rppr*
         argument.
 
+        If *native* is ``True``, the tree is instead rerooted in process
+        with ``algotax.reroot_from_rp``, and ``rppr`` is not needed.
+
         If *pretend* is ``True``, the convexification is run, but the
         refpkg is not actually updated.
         """
         with scratch_file(prefix='tree', suffix='.tre') as name:
-            # Use a specific path to rppr, otherwise rely on $PATH
-            subprocess.check_call([rppr or 'rppr', 'reroot',
-                                   '-c', self.path, '-o', name])
+            if native:
+                self._reroot_native(name)
+            else:
+                # Use a specific path to rppr, otherwise rely on $PATH
+                subprocess.check_call([rppr or 'rppr', 'reroot',
+                                       '-c', self.path, '-o', name])
             if not(pretend):
                 self.update_file('tree', name)
         self._log('Rerooting refpkg')
 
+    def _reroot_native(self, out_path):
+        """Write the taxonomically rerooted tree to *out_path*."""
+        with self.open_resource('tree') as fobj:
+            tree = Bio.Phylo.read(fobj, 'newick')
+        if self.db is None:
+            self.load_db()
+        new_root = algotax.reroot_from_rp(tree.root, self)
+        if new_root is not tree.root:
+            # An inner clade becomes the new (multifurcating) root; the old
+            # root is dropped if it was bifurcating.
+            tree.root_with_outgroup(new_root)
+        # '%r' keeps branch lengths at full precision
+        Bio.Phylo.write(tree, out_path, 'newick', format_branch_length='%r')
+
     def update_phylo_model(self, stats_type, stats_file):
         """Parse a stats log and use it to update ``phylo_model``.
 
@@ -689,14 +795,62 @@ class Refpkg(object):
         return False
 
 
-    def load_db(self):
+    def load_db(self, cache=True, cache_dir=None):
         """Load the taxonomy into a sqlite3 database.
 
         This will set ``self.db`` to a sqlite3 database which contains all of
         the taxonomic information in the reference package.
-        """
 
-        db = taxdb.Taxdb()
+        If *cache* is true, the database is stored as a file in *cache_dir*
+        (default: ``default_cache_dir()``), named for the MD5 sums of the
+        ``taxonomy`` and ``seq_info`` resources, and later calls for a refpkg
+        with the same resources open that file instead of rebuilding it. The
+        cached file is never modified once written; one that can't be read is
+        rebuilt. Writing a new file removes all but the ``TAXDB_CACHE_SIZE``
+        most recently written databases from *cache_dir*. If the cache directory can't be written to, an in-memory
+        database is built instead.
+        """
+        if not cache:
+            self.db = self._build_db(sqlite3.connect(':memory:'))
+            return
+
+        cache_dir = cache_dir or default_cache_dir()
+        key = hashlib.md5(':'.join([
+            TAXDB_CACHE_VERSION,
+            self.resource_md5('taxonomy'),
+            self.resource_md5('seq_info')])).hexdigest()
+        path = os.path.join(cache_dir, key + '.db')
+        self.db = _open_cached_db(path)
+        if self.db is not None:
+            return
+
+        try:
+            if not os.path.isdir(cache_dir):
+                os.makedirs(cache_dir)
+            tmp_fd, tmp_name = tempfile.mkstemp(
+                dir=cache_dir, prefix=key, suffix='.tmp')
+        except OSError, e:
+            warnings.warn("can't write taxonomy database cache to {0}: {1}"
+                          .format(cache_dir, e))
+            self.db = self._build_db(sqlite3.connect(':memory:'))
+            return
+
+        os.close(tmp_fd)
+        try:
+            db = self._build_db(sqlite3.connect(tmp_name))
+            # Renaming is atomic, so concurrent loaders either see no file
+            # or a complete one. The open connection follows the file, even
+            # if it is pruned later.
+            os.rename(tmp_name, path)
+        except:
+            os.unlink(tmp_name)
+            raise
+        self.db = db
+        _prune_cache(cache_dir)
+
+    def _build_db(self, con):
+        """Fill the empty sqlite3 database *con* and return it as a Taxdb."""
+        db = taxdb.Taxdb(con)
         db.create_tables()
         reader = csv.DictReader(self.open_resource('taxonomy', 'rU'))
         db.insert_from_taxtable(lambda: reader._fieldnames, reader)
@@ -707,81 +861,35 @@ class Refpkg(object):
             ((row['seqname'], row['tax_id']) for row in reader))
 
         db.commit()
-        self.db = db
+        return db
+
+    def lca_index(self):
+        """Return a :class:`taxtastic.taxtable.LCAIndex` over the taxonomy.
+
+        The index is built on first use and rebuilt only when the MD5 sum of
+        the ``taxonomy`` resource changes.
+        """
+        md5 = self.resource_md5('taxonomy')
+        if self._lca_index is None or self._lca_index[0] != md5:
+            with self.open_resource('taxonomy', 'rU') as fp:
+                index = taxtable.TaxNode.from_taxtable(fp).lca_index()
+            self._lca_index = md5, index
+        return self._lca_index[1]
 
     def most_recent_common_ancestor(self, *ts):
         """Find the MRCA of some tax_ids.
 
         Returns the MRCA of the specified tax_ids, or raises ``NoAncestor`` if
         no ancestor of the specified tax_ids could be found.
-        """
-        if len(ts) > 200:
-            res = self._large_mrca(ts)
-        else:
-            res = self._small_mrca(ts)
 
-        if res:
-            (res,), = res
-        else:
+        Queries are answered from ``lca_index()`` in time linear in the number
+        of tax_ids, and do not require ``load_db``.
+        """
+        index = self.lca_index()
+        try:
+            return index.mrca(*ts)
+        except (KeyError, ValueError):
             raise NoAncestor()
-        return res
-
-    def _large_mrca(self, ts):
-        """Find the MRCA using a temporary table."""
-        cursor = self.db.cursor()
-
-        cursor.execute("""
-            DROP TABLE IF EXISTS _mrca_temp
-        """)
-
-        cursor.execute("""
-            CREATE TEMPORARY TABLE _mrca_temp(
-                child TEXT PRIMARY KEY REFERENCES taxa (tax_id) NOT NULL
-            )
-        """)
-
-        cursor.executemany("""
-            INSERT INTO _mrca_temp
-            VALUES (?)
-        """, ((tid,) for tid in ts))
-        cursor.execute("""
-            SELECT parent
-            FROM   _mrca_temp
-                   JOIN parents USING (child)
-                   JOIN taxa
-                     ON parent = taxa.tax_id
-                   JOIN ranks USING (rank)
-            GROUP  BY parent
-            HAVING COUNT(*) = ?
-            ORDER  BY rank_order DESC
-            LIMIT  1
-        """, (len(ts),))
-
-        return cursor.fetchall()
-
-    def _small_mrca(self, ts):
-        """Find a MRCA using query parameters.
-
-        This only supports a limited number of tax_ids; ``_large_mrca`` will
-        support an arbitrary number.
-        """
-        cursor = self.db.cursor()
-        qmarks = ', '.join('?' * len(ts))
-        cursor.execute("""
-            SELECT parent
-            FROM   parents
-                   JOIN taxa
-                     ON parent = taxa.tax_id
-                   JOIN ranks USING (rank)
-            WHERE  child IN (%s)
-            GROUP  BY parent
-            HAVING COUNT(*) = ?
-            ORDER  BY rank_order DESC
-            LIMIT  1
-        """ % qmarks, ts + (len(ts),))
-
-        return cursor.fetchall()
-
 
     def file_abspath(self, resource):
         """Deprecated alias for *resource_path*."""
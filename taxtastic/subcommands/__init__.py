@@ -28,6 +28,7 @@ commands = [
     'rollforward',
     'rp',
     'refpkg_intersection',
+    'convexify',
     ]
 
 import glob
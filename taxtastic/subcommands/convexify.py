@@ -0,0 +1,157 @@
+"""Finds the sequences to cut to make each rank of a refpkg convex
+
+For each rank, the leaves of the reference tree are colored by the taxon at
+that rank of their sequence, and the largest set of leaves whose colors form
+convex subtrees is found (see taxtastic.algotax). The remaining colored
+sequences are written out as (rank, seqname, tax_id) rows, where tax_id is
+the sequence's taxon at that rank.
+
+Ranks are independent, and are solved in parallel in a pool of worker
+processes. A timing report is written with one row per rank.
+"""
+# This file is part of taxtastic.
+#
+#    taxtastic is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    taxtastic is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with taxtastic.  If not, see <http://www.gnu.org/licenses/>.
+import argparse
+import csv
+import logging
+import multiprocessing
+import sys
+import time
+
+from Bio import Phylo
+
+from taxtastic import algotax, refpkg
+
+log = logging.getLogger(__name__)
+
+def comma_separated_list(s):
+    return [i.strip() for i in s.split(',') if i.strip()]
+
+def build_parser(parser):
+    parser.add_argument('refpkg', action='store', metavar='refpkg',
+                        help='the reference package to operate on')
+    parser.add_argument('-r', '--ranks', type=comma_separated_list,
+                        help="""comma separated list of ranks to convexify
+                        [default: all ranks in the taxonomy]""")
+    parser.add_argument('-o', '--outfile', type=argparse.FileType('w'),
+                        default=sys.stdout,
+                        help='output file in csv format (default is stdout)')
+    parser.add_argument('-t', '--timings', type=argparse.FileType('w'),
+                        default=sys.stderr,
+                        help='timing report in csv format (default is stderr)')
+    parser.add_argument('-j', '--processes', type=int, default=None,
+                        help="""number of worker processes [default: the
+                        number of CPUs, at most one per rank]""")
+    parser.add_argument('--max-states', type=int, default=None,
+                        help="""keep at most this many partial solutions per
+                        color at each node; faster, but may cut more
+                        sequences than necessary""")
+
+def rank_colors(db, rank):
+    """
+    Return a dict mapping each seqname in *db* to the tax_id of its ancestor
+    at *rank*; sequences without one are left out.
+    """
+    return dict(db.cursor().execute("""
+        SELECT s.seqname,
+               t.tax_id
+        FROM   taxa t
+               JOIN hierarchy ht USING (tax_id)
+               JOIN hierarchy hs
+                 ON hs.lft BETWEEN ht.lft AND ht.rgt
+               JOIN sequences s
+                 ON s.tax_id = hs.tax_id
+        WHERE  t.rank = ?
+    """, (rank,)))
+
+# Each worker reads the tree once, in `init_worker`, and then solves any
+# number of ranks against it.
+_tree = None
+_leaves = None
+
+def init_worker(tree_path):
+    global _tree, _leaves
+    _tree = Phylo.read(tree_path, 'newick')
+    # Tree.get_terminals recurses, which fails on very deep trees.
+    _leaves = {}
+    stack = [_tree.root]
+    while stack:
+        clade = stack.pop()
+        if clade.clades:
+            stack.extend(clade.clades)
+        else:
+            _leaves[clade.name] = clade
+
+def solve_rank(job):
+    """
+    Convexify one rank. *job* is ``(rank, colors, max_states)``, where
+    *colors* maps seqnames to tax_ids. Returns ``(rank, cut, leaves, taxa,
+    seconds)``, where *cut* is a list of ``(seqname, tax_id)`` pairs.
+    """
+    rank, colors, max_states = job
+    start = time.time()
+    leaf_colors = {_leaves[name]: tax_id
+                   for name, tax_id in colors.iteritems() if name in _leaves}
+    metadata = algotax.color_clades(_tree, leaf_colors)
+    keep = algotax.walk(_tree.root, metadata, max_states=max_states)
+    cut = sorted((leaf.name, tax_id)
+                 for leaf, tax_id in leaf_colors.iteritems()
+                 if leaf not in keep)
+    return (rank, cut, len(leaf_colors), len(set(leaf_colors.itervalues())),
+            time.time() - start)
+
+def action(args):
+    rp = refpkg.Refpkg(args.refpkg, create=False)
+    rp.load_db()
+
+    ranks = args.ranks
+    if ranks is None:
+        ranks = [rank for rank, in rp.db.cursor().execute(
+            "SELECT rank FROM ranks ORDER BY rank_order")]
+    jobs = [(rank, rank_colors(rp.db, rank), args.max_states)
+            for rank in ranks]
+
+    tree_path = rp.resource_path('tree')
+    processes = min(args.processes or multiprocessing.cpu_count(), len(jobs))
+    start = time.time()
+    if processes > 1:
+        pool = multiprocessing.Pool(processes, init_worker, (tree_path,))
+        try:
+            results = list(pool.imap_unordered(solve_rank, jobs))
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+    else:
+        init_worker(tree_path)
+        results = [solve_rank(job) for job in jobs]
+    elapsed = time.time() - start
+
+    # Results arrive as they finish; report them in the order requested.
+    results.sort(key=lambda result: ranks.index(result[0]))
+
+    writer = csv.writer(args.outfile)
+    writer.writerow(('rank', 'seqname', 'tax_id'))
+    for rank, cut, _, _, _ in results:
+        writer.writerows((rank, seqname, tax_id) for seqname, tax_id in cut)
+
+    writer = csv.writer(args.timings)
+    writer.writerow(('rank', 'sequences', 'taxa', 'cut', 'seconds'))
+    for rank, cut, leaves, taxa, seconds in results:
+        writer.writerow((rank, leaves, taxa, len(cut), '%.3f' % seconds))
+    writer.writerow(('total', '', '', sum(len(r[1]) for r in results),
+                     '%.3f' % elapsed))
+    log.info('convexified %d ranks in %d processes', len(results), processes)
+    return 0
@@ -88,6 +88,9 @@ def build_parser(parser):
             taxonomy file is specified]""")
     root_grp.add_argument('--rppr', default='rppr', help="""Name of the rppr
             executable. [default: %(default)s]""")
+    root_grp.add_argument('--native-reroot', action='store_true',
+            default=False, help="""Reroot without calling `rppr`, which then
+            need not be installed.""")
 
 
 def action(args):
@@ -130,10 +133,13 @@ def action(args):
     r.strip()
 
     reroot_prereqs = args.reroot and args.taxonomy and args.seq_info and args.tree
-    if utils.has_rppr(args.rppr) and reroot_prereqs:
+    if reroot_prereqs and (args.native_reroot or utils.has_rppr(args.rppr)):
         r.start_transaction()
-        logging.info('%s found. Rerooting.', args.rppr)
-        r.reroot(rppr=args.rppr)
+        if args.native_reroot:
+            logging.info('Rerooting without rppr.')
+        else:
+            logging.info('%s found. Rerooting.', args.rppr)
+        r.reroot(rppr=args.rppr, native=args.native_reroot)
         r._log('Rerooted')
         r.commit_transaction()
     elif reroot_prereqs:
@@ -1,4 +1,9 @@
-"""Extracts tax ids of all lonely nodes in a taxtable."""
+"""Extracts tax ids of all lonely nodes in a taxtable.
+
+The target may also be a taxonomy database created by ``taxit
+new_database``, in which case lonely nodes are found with a single query and
+written out as they are read, without loading the taxonomy into memory.
+"""
 # This file is part of taxtastic.
 #
 #    taxtastic is free software: you can redistribute it and/or modify
@@ -18,7 +23,10 @@ import logging
 import os
 import sys
 
-from taxtastic import lonely, refpkg
+from sqlalchemy import create_engine
+
+from taxtastic import lonely, ncbi, refpkg
+from taxtastic.taxonomy import Taxonomy
 
 log = logging.getLogger(__name__)
 
@@ -32,42 +40,57 @@ def build_parser(parser):
     parser.add_argument("target",
                         metavar = "taxtable_or_refpkg",
                         action="store",
-                        help='A taxtable or a refpkg containing a taxtable')
+                        help="""A taxtable, a refpkg containing a
+                        taxtable, or a taxonomy database""")
     parser.add_argument('-o', '--output',
                         action='store', default=None,
                         help='Write output to given file')
     parser.add_argument('-r', '--ranks', help="""Comma separated list of ranks
             to consider [default: all ranks]""", type=comma_separated_set)
 
+def is_sqlite(path):
+    with open(path, 'rb') as h:
+        return h.read(16) == 'SQLite format 3\x00'
+
 def action(args):
     if not(os.path.exists(args.target)):
         print >>sys.stderr, "Failed: no such target %s" % args.target
         return 1
     elif os.path.isdir(args.target):
         try:
-            if args.verbose:
+            if args.verbosity > 1:
                 print >>sys.stderr, "Target is a refpkg. Working on taxonomy within it."
             r = refpkg.Refpkg(args.target, create=False)
             path = r.file_abspath('taxonomy')
         except Exception, e:
             print >>sys.stderr, "Failed: %s" % str(e)
             return 1
+    elif is_sqlite(args.target):
+        if args.verbosity > 1:
+            print >>sys.stderr, "Target is a taxonomy database."
+        path = None
     else:
-        if args.verbose:
+        if args.verbosity > 1:
             print >>sys.stderr, "Target is a CSV file."
         path = args.target
 
-    print >>sys.stderr, "Loading taxonomy from file...",
-    with open(path) as h:
-        tree = lonely.taxtable_to_tree(h)
-    print >>sys.stderr, "done."
-    result = tree.lonelynodes()
-    if args.ranks:
-        result = (n for n in result if n.rank in args.ranks)
-    txt = '\n'.join("%s # %s %s" % (n.key if n.key else "", n.rank, n.tax_name) for n in result)
-    if args.output:
-        with open(args.output, 'w') as out:
-            print >>out, txt
+    if path is None:
+        engine = create_engine('sqlite:///%s' % args.target, echo=False)
+        result = Taxonomy(engine, ncbi.ranks).lonely_nodes(args.ranks)
     else:
-        print txt
+        print >>sys.stderr, "Loading taxonomy from file...",
+        with open(path) as h:
+            tree = lonely.taxtable_to_tree(h)
+        print >>sys.stderr, "done."
+        result = ((n.key, n.rank, n.tax_name) for n in tree.lonelynodes())
+        if args.ranks:
+            result = (n for n in result if n[1] in args.ranks)
+
+    out = open(args.output, 'w') if args.output else sys.stdout
+    try:
+        for tax_id, rank, tax_name in result:
+            print >>out, "%s # %s %s" % (tax_id if tax_id else "", rank, tax_name)
+    finally:
+        if args.output:
+            out.close()
     return 0
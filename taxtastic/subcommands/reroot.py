@@ -24,10 +24,12 @@ def build_parser(parser):
                         help='the reference package to operate on')
     parser.add_argument('--rppr', action='store', default=None,
                         help="specify the rppr binary to call to perform the rerooting")
+    parser.add_argument('--native', action='store_true', default=False,
+                        help="reroot without calling rppr")
     parser.add_argument('-p', '--pretend',
                         action='store_true', default=False,
                         help="don't save the rerooted tree; just attempt the rerooting.")
 
 def action(args):
     r = refpkg.Refpkg(args.refpkg, create=False)
-    r.reroot(rppr=args.rppr, pretend=args.pretend)
+    r.reroot(rppr=args.rppr, pretend=args.pretend, native=args.native)
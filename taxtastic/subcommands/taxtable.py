@@ -79,6 +79,15 @@ def build_parser(parser):
         help="""Output file containing lineages for the specified taxa
         in csv format; writes to stdout if unspecified""")
 
+    parser.add_argument(
+        '-f', '--output-format',
+        dest='output_format',
+        choices=['csv', 'columnar'],
+        default='csv',
+        help="""Format of the output file: csv, or a compact binary
+        columnar format readable with
+        taxtastic.taxtable.TaxNode.from_columnar [default: %(default)s]""")
+
 def action(args):
     engine = create_engine('sqlite:///%s' % args.database_file, echo=args.verbosity > 2)
     tax = Taxonomy(engine, ncbi.ranks)
@@ -127,7 +136,8 @@ def action(args):
     for t in taxids:
         taxids_to_export.update([y for (x,y) in tax._get_lineage(t)])
 
-    tax.write_table(taxids_to_export, csvfile = args.out_file)
+    tax.write_table(taxids_to_export, csvfile = args.out_file,
+                    output_format = args.output_format)
 
     engine.dispose()
     return 0
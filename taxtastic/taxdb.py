@@ -1,59 +1,51 @@
 import itertools
 import sqlite3
 
-class OnUpdate(object):
-    def __init__(self, proxied):
-        self.proxied = proxied
-        self.setter = None
-
-    def __get__(self, inst, cls):
-        if inst is None:
-            return self
-        return getattr(inst, self.proxied)
-
-    def __set__(self, inst, value):
-        if self.setter:
-            self.setter(inst, value)
-        setattr(inst, self.proxied, value)
-
-    def __call__(self, f):
-        self.setter = f
-        return self
-
-class _IntermediateTaxon(object):
-    def __init__(self, tax_id, parent, rank, tax_name):
-        self.children = set()
-        self.tax_id = tax_id
-        self.parent = parent
-        self.rank = rank
-        self.tax_name = tax_name
-
-    _parent = _adjacent_to = None
-
-    @OnUpdate('_parent')
-    def parent(self, p):
-        if self.parent is not None:
-            self.parent.children.discard(self)
-        if p is not None:
-            p.children.add(self)
-
-    @OnUpdate('_adjacent_to')
-    def adjacent_to(self, n):
-        if n is not None:
-            self.parent = n.parent
-
-    def iterate_children(self, on_pop=None, including_self=True):
-        search_stack = [(None, set([self]))]
-        while search_stack:
-            if not search_stack[-1][1]:
-                parent, _ = search_stack.pop()
-                if on_pop:
-                    on_pop(parent)
-                continue
-            node = search_stack[-1][1].pop()
-            if node is not self or including_self:
-                yield node
-            search_stack.append((node, node.children.copy()))
+# Number of rows passed to each executemany call when bulk loading.
+BATCH_SIZE = 50000
+
+def nested_set(parents):
+    """
+    Compute nested set numbering for a tree given as a sequence of parent
+    indices, where roots are their own parents.
+
+    Returns two lists, ``(lft, rgt)``, indexed like *parents*.
+    """
+    children = [[] for _ in xrange(len(parents))]
+    roots = []
+    for i, p in enumerate(parents):
+        if p == i:
+            roots.append(i)
+        else:
+            children[p].append(i)
+
+    lft = [None] * len(parents)
+    rgt = [None] * len(parents)
+    counter = 1
+    # Nodes are pushed as their index when entered and as the complement of
+    # their index once all of their children have been pushed.
+    stack = roots[::-1]
+    while stack:
+        i = stack.pop()
+        if i >= 0:
+            lft[i] = counter
+            stack.append(~i)
+            stack.extend(children[i])
+        else:
+            rgt[~i] = counter
+        counter += 1
+    return lft, rgt
+
+def batched(iterable, size=BATCH_SIZE):
+    """
+    Yield successive lists of at most *size* items from *iterable*.
+    """
+    it = iter(iterable)
+    while True:
+        batch = list(itertools.islice(it, size))
+        if not batch:
+            return
+        yield batch
 
 class Taxdb(object):
     def __init__(self, sqlite_db=None):
@@ -65,6 +57,7 @@ class Taxdb(object):
         return getattr(self.db, attr)
 
     def create_tables(self):
+        """Create the tables of an empty taxonomy database."""
         curs = self.db.cursor()
 
         curs.execute("""
@@ -97,6 +90,10 @@ class Taxdb(object):
             )
         """)
 
+        curs.execute("""
+            CREATE INDEX hierarchy_lft_rgt ON hierarchy (lft, rgt, tax_id)
+        """)
+
         curs.execute("""
             CREATE VIEW parents AS
             SELECT h1.tax_id AS child,
@@ -107,30 +104,54 @@ class Taxdb(object):
         """)
 
     def insert_from_taxtable(self, fieldnames_cb, table):
+        """
+        Insert the rows of a taxtable (an iterable of dicts, e.g. a
+        ``csv.DictReader``). Rows whose ``parent_id`` is their own
+        ``tax_id`` or is missing from *table* are treated as roots.
+        """
         curs = self.db.cursor()
 
-        taxon_map = {}
+        tax_ids, parent_ids, ranks, tax_names = [], [], [], []
         for row in table:
-            parent = taxon_map.get(row['parent_id'])
-            taxon = _IntermediateTaxon(
-                row['tax_id'], parent, row['rank'], row['tax_name'])
-            taxon_map[taxon.tax_id] = taxon
-
-        root = next(taxon_map.itervalues())
-        while root.parent is not None:
-            root = root.parent
-        counter = itertools.count(1).next
-        def on_pop(parent):
-            if parent is not None:
-                parent.rgt = counter()
-        for node in root.iterate_children(on_pop=on_pop):
-            node.lft = counter()
+            tax_ids.append(row['tax_id'])
+            parent_ids.append(row['parent_id'])
+            ranks.append(row['rank'])
+            tax_names.append(row['tax_name'])
+
+        index = dict(itertools.izip(tax_ids, itertools.count()))
+        parents = [index.get(p, i) for i, p in enumerate(parent_ids)]
+        del parent_ids, index
 
         fieldnames = fieldnames_cb()
         curs.executemany("INSERT INTO ranks (rank_order, rank) VALUES (?, ?)",
             enumerate(fieldnames[4:]))
-        curs.executemany("INSERT INTO taxa VALUES (?, ?, ?)",
-            ((t.tax_id, t.tax_name, t.rank) for t in taxon_map.itervalues()))
-        curs.executemany("INSERT INTO hierarchy VALUES (?, ?, ?)",
-            ((t.tax_id, t.lft, t.rgt) for t in taxon_map.itervalues()))
+        for batch in batched(itertools.izip(tax_ids, tax_names, ranks)):
+            curs.executemany("INSERT INTO taxa VALUES (?, ?, ?)", batch)
+        self._insert_hierarchy(tax_ids, parents)
+        self.db.commit()
+
+    def insert_from_columnar(self, table):
+        """
+        Insert the contents of a :class:`taxtastic.coltable.ColumnarTaxtable`.
+        """
+        curs = self.db.cursor()
+        curs.executemany("INSERT INTO ranks (rank_order, rank) VALUES (?, ?)",
+            enumerate(table.ranks))
+        names, rank_values = table.names, table.rank_values
+        taxa = itertools.izip(table.tax_ids,
+                              (names[i] for i in table.name_codes),
+                              (rank_values[i] for i in table.rank_codes))
+        for batch in batched(taxa):
+            curs.executemany("INSERT INTO taxa VALUES (?, ?, ?)", batch)
+        self._insert_hierarchy(table.tax_ids, table.parents)
         self.db.commit()
+
+    def _insert_hierarchy(self, tax_ids, parents):
+        """
+        Fill ``hierarchy`` for the taxa *tax_ids*, whose parents are given as
+        indices into *tax_ids*.
+        """
+        curs = self.db.cursor()
+        lft, rgt = nested_set(parents)
+        for batch in batched(itertools.izip(tax_ids, lft, rgt)):
+            curs.executemany("INSERT INTO hierarchy VALUES (?, ?, ?)", batch)
@@ -19,10 +19,10 @@ import itertools
 log = logging
 
 import sqlalchemy
-from sqlalchemy import MetaData, and_, or_
+from sqlalchemy import MetaData, and_, or_, func
 from sqlalchemy.sql import select
 
-from . import ncbi
+from . import coltable, ncbi
 
 class Taxonomy(object):
 
@@ -264,7 +264,7 @@ class Taxonomy(object):
 
         return ldict
 
-    def write_table(self, taxa=None, csvfile=None, full=False):
+    def write_table(self, taxa=None, csvfile=None, full=False, output_format='csv'):
         """
         Represent the currently defined taxonomic lineages as a rectangular
         array with columns named "tax_id","rank","tax_name", followed
@@ -276,6 +276,8 @@ class Taxonomy(object):
          * csvfile - an open file-like object (see "csvfile" argument to csv.writer)
          * full - if True (the default), includes a column for each rank in self.ranks;
            otherwise, omits ranks (columns) the are undefined for all taxa.
+         * output_format - 'csv', or 'columnar' to write the compact binary
+           format described in taxtastic.coltable.
         """
 
         if not taxa:
@@ -293,6 +295,15 @@ class Taxonomy(object):
             ranks = [r for r in self.ranks if r in represented]
 
         lineages = [self.lineage(tax_id) for tax_id in taxa]
+        lineages.sort(key=lambda x: (ranks.index(x['rank']), x['tax_name']))
+
+        if output_format == 'columnar':
+            coltable.write(csvfile, ranks,
+                ((lin['tax_id'], lin['parent_id'], lin['rank'], lin['tax_name'])
+                 for lin in lineages))
+            return
+        elif output_format != 'csv':
+            raise ValueError('invalid output format: %r' % (output_format,))
 
         fields = ['tax_id', 'parent_id', 'rank', 'tax_name'] + ranks
         writer = csv.DictWriter(csvfile, fieldnames=fields,
@@ -301,7 +312,7 @@ class Taxonomy(object):
         # header row
         writer.writeheader()
 
-        for lin in sorted(lineages, key=lambda x: (ranks.index(x['rank']), x['tax_name'])):
+        for lin in lineages:
              writer.writerow(lin)
 
     def add_source(self, name, description=None):
@@ -408,7 +419,7 @@ class Taxonomy(object):
             return None
         else:
             r = output[0]
-            assert self.is_ancestor_of(r, tax_id)
+            self._check_below(tax_id, [r])
             return r
 
     def children_of(self, tax_id, n):
@@ -424,10 +435,37 @@ class Taxonomy(object):
             return []
         else:
             r = [x[0] for x in output]
-            for x in r:
-                assert self.is_ancestor_of(x, tax_id)
+            self._check_below(tax_id, r)
             return r
 
+    def lonely_nodes(self, ranks=None):
+        """Generate ``(tax_id, rank, tax_name)`` for each node whose parent
+        has exactly one child.
+
+        If *ranks* is given, only nodes with one of those ranks are
+        generated. Lonely nodes are found by grouping ``nodes`` on
+        ``parent_id`` in a single scan, and rows are streamed from the
+        database, so this works on taxonomies too large to load into memory.
+        """
+        nodes = self.nodes
+        # With one child per group, MIN() picks out that child's columns.
+        tax_id = func.min(nodes.c.tax_id)
+        rank = func.min(nodes.c.rank)
+        lonely = select([tax_id.label('tax_id'), rank.label('rank')],
+                        nodes.c.tax_id != nodes.c.parent_id)
+        lonely = lonely.group_by(nodes.c.parent_id).having(func.count() == 1)
+        if ranks is not None:
+            lonely = lonely.having(rank.in_(list(ranks)))
+        lonely = lonely.alias('lonely')
+
+        names = self.names
+        s = select([lonely.c.tax_id, lonely.c.rank, names.c.tax_name],
+                   from_obj=[lonely.outerjoin(
+                       names, and_(names.c.tax_id == lonely.c.tax_id,
+                                   names.c.is_primary == 1))])
+        for row in s.execute():
+            yield tuple(row)
+
     def parent_id(self, tax_id):
         if tax_id is None:
             return None
@@ -467,9 +505,22 @@ class Taxonomy(object):
         else:
             c = self.child_of(tax_id)
             newc = self.species_below(c)
-            assert self.is_ancestor_of(newc, tax_id)
+            # None if there is no species below tax_id
+            if newc is not None:
+                self._check_below(tax_id, [newc])
             return newc
 
+    def _check_below(self, tax_id, descendants):
+        """
+        Assert that *tax_id* is an ancestor of each of *descendants*.
+
+        Results selected by parent_id always are; since each check costs
+        several queries, it is only made when debug logging is enabled.
+        """
+        if logging.getLogger().isEnabledFor(logging.DEBUG):
+            for d in descendants:
+                assert self.is_ancestor_of(d, tax_id)
+
 ranks = ['species', 'genus', 'family', 'order', 'class', 'phylum', 'kingdom']
 
 def is_below(lower, upper):
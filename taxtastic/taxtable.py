@@ -2,25 +2,93 @@
 Representation of a taxonomic hierarchy.
 """
 
+import array
 import collections
 import csv
+import itertools
+import logging
+
+from taxtastic import coltable
+
+log = logging.getLogger(__name__)
+
 
 class TaxNode(object):
     """
     Taxonomic tree, with optional sequence IDs on nodes.
+
+    Nodes use ``__slots__``, and the ``children`` and ``sequence_ids`` sets
+    and the root's ``index`` are only allocated when first used, so that
+    large trees (where most nodes are leaves without sequences) stay small.
+    As a result, TaxNode instances have no ``__dict__``, and other attributes
+    can't be set on them; subclasses which need additional attributes may
+    define them as usual.
     """
+    __slots__ = ('ranks', 'rank', 'name', 'tax_id', 'parent',
+                 '_sequence_ids', '_children', '_index')
+
+    def __getstate__(self):
+        # Slotted classes don't pickle without this; unassigned slots (such
+        # as ``_index`` on unlinked nodes) are left out.
+        state = dict(getattr(self, '__dict__', ()))
+        for name in TaxNode.__slots__:
+            try:
+                state[name] = getattr(self, name)
+            except AttributeError:
+                pass
+        return state
+
+    def __setstate__(self, state):
+        for name, value in state.iteritems():
+            setattr(self, name, value)
+
     def __init__(self, rank, tax_id, parent=None, sequence_ids=None, children=None, name=None):
         self.ranks = None
         self.rank = rank
         self.name = name
         self.tax_id = tax_id
         self.parent = parent
-        self.sequence_ids = sequence_ids or set()
-        self.children = children or set()
+        self._sequence_ids = sequence_ids or None
+        self._children = children or None
         assert tax_id != ""
 
-        if self.is_root:
-            self.index = {self.tax_id: self}
+    @property
+    def sequence_ids(self):
+        if self._sequence_ids is None:
+            self._sequence_ids = set()
+        return self._sequence_ids
+
+    @sequence_ids.setter
+    def sequence_ids(self, value):
+        self._sequence_ids = value
+
+    @property
+    def children(self):
+        if self._children is None:
+            self._children = set()
+        return self._children
+
+    @children.setter
+    def children(self, value):
+        self._children = value
+
+    @property
+    def index(self):
+        """
+        Dictionary mapping tax_id to node, shared by all nodes in a tree.
+        """
+        try:
+            return self._index
+        except AttributeError:
+            # Not yet assigned: create the index if this is a root
+            if not self.is_root:
+                raise
+            self._index = {self.tax_id: self}
+            return self._index
+
+    @index.setter
+    def index(self, value):
+        self._index = value
 
     def add_child(self, child):
         """
@@ -54,17 +122,36 @@ class TaxNode(object):
             if n.index is self.index:
                 n.index = None
 
+    def prune(self, keep):
+        """
+        Remove nodes below this node, except those for which ``keep(node)``
+        is true and their ancestors.
+
+        This is done in a single pass over the nodes, children before their
+        parents: each removed node is discarded from its parent's children,
+        dropped from the index and detached, so a parent left without
+        children is itself removed when it is reached.
+        """
+        index = self.index
+        nodes = list(self.depth_first_iter())
+        for node in reversed(nodes):
+            if node is self or node._children or keep(node):
+                continue
+            node.parent._children.discard(node)
+            node.parent = None
+            index.pop(node.tax_id)
+            if node.index is index:
+                node.index = None
+
     def prune_unrepresented(self):
         """
         Remove nodes without sequences or children below this node.
         """
-        for node in self.depth_first_iter(self_first=False):
-            if not node.children and not node.sequence_ids and node is not self:
-                node.parent.remove_child(node)
+        self.prune(lambda node: node._sequence_ids)
 
     @property
     def is_leaf(self):
-        return not self.children
+        return not self._children
 
     @property
     def is_root(self):
@@ -82,40 +169,112 @@ class TaxNode(object):
         raise KeyError("No node at rank {0} for {1}".format(rank,
             self.tax_id))
 
+    def ancestors_at_rank(self, rank):
+        """
+        Find the node at rank ``rank`` above each node at or below this node.
+
+        Returns a dictionary mapping tax_id to node, equivalent to calling
+        :meth:`at_rank` on every node, but computed with one top-down pass;
+        nodes without an ancestor at ``rank`` are omitted.
+        """
+        try:
+            top = self.at_rank(rank)
+        except KeyError:
+            top = None
+        result = {}
+        stack = [(self, top)]
+        while stack:
+            node, ancestor = stack.pop()
+            if node.rank == rank:
+                ancestor = node
+            if ancestor is not None:
+                result[node.tax_id] = ancestor
+            if node._children:
+                stack.extend((child, ancestor) for child in node._children)
+        return result
+
+    def rank_lineage_iter(self):
+        """
+        Iterate over this node and its descendants in pre-order, yielding
+        ``(node, ranks)``, where ``ranks`` maps each rank in the lineage of
+        ``node`` to the nearest node at that rank at or above ``node``.
+
+        Each mapping is built from the parent's, so iterating over the whole
+        tree takes time linear in its size rather than one lineage walk per
+        node. The mappings must not be modified.
+        """
+        top = {}
+        for node in self.lineage()[:-1]:
+            top[node.rank] = node
+        stack = [(self, top)]
+        while stack:
+            node, parent_ranks = stack.pop()
+            ranks = dict(parent_ranks)
+            ranks[node.rank] = node
+            yield node, ranks
+            if node._children:
+                stack.extend((child, ranks) for child in node._children)
+
     def depth_first_iter(self, self_first=True):
         """
         Iterate over nodes below this node, optionally yielding children before
         self.
+
+        Traversal uses an explicit stack, so it is not limited by the
+        recursion limit on deep trees. The children of each node are copied
+        when the node is expanded, so nodes already yielded may be removed
+        from the tree during iteration.
         """
         if self_first:
-            yield self
-        for child in list(self.children):
-            for i in child.depth_first_iter(self_first):
-                yield i
-        if not self_first:
-            yield self
+            stack = [self]
+            while stack:
+                node = stack.pop()
+                yield node
+                if node._children:
+                    stack.extend(node._children)
+        else:
+            # Each node is pushed twice: first to be expanded, then (after
+            # its children) to be yielded.
+            stack = [(self, False)]
+            while stack:
+                node, expanded = stack.pop()
+                if expanded:
+                    yield node
+                else:
+                    stack.append((node, True))
+                    if node._children:
+                        stack.extend((child, False) for child in node._children)
+
+    def breadth_first_iter(self):
+        """
+        Iterate over nodes below this node, level by level, starting with self.
+        """
+        queue = collections.deque([self])
+        while queue:
+            node = queue.popleft()
+            yield node
+            if node._children:
+                queue.extend(node._children)
 
     def subtree_sequence_ids(self):
         """
         Generate all sequence IDs at or below this node.
         """
         for node in self:
-            for s in node.sequence_ids:
-                yield s
+            if node._sequence_ids:
+                for s in node._sequence_ids:
+                    yield s
 
     def path(self, tax_ids):
         """Get the node at the end of the path described by tax_ids."""
         assert tax_ids[0] == self.tax_id
-        if len(tax_ids) == 1:
-            return self
-
-        n = tax_ids[1]
-        try:
-            child = next(i for i in self.children if i.tax_id == n)
-        except StopIteration:
-            raise KeyError(n)
-
-        return child.path(tax_ids[1:])
+        node = self
+        for n in tax_ids[1:]:
+            try:
+                node = next(i for i in node._children or () if i.tax_id == n)
+            except StopIteration:
+                raise KeyError(n)
+        return node
 
     def get_node(self, tax_id):
         """
@@ -127,15 +286,17 @@ class TaxNode(object):
         """
         Return all nodes between this node and the root, including this one.
         """
-        if not self.parent: return [self]
-        else:
-            l = self.parent.lineage()
-            l.append(self)
-            return l
+        l = []
+        node = self
+        while node is not None:
+            l.append(node)
+            node = node.parent
+        l.reverse()
+        return l
 
     def __repr__(self):
         return "<TaxNode {0.tax_id}:{0.name} [rank={0.rank};children={1};sequences={2}]>".format(
-            self, len(self.children), len(self.sequence_ids))
+            self, len(self._children or ()), len(self._sequence_ids or ()))
 
     def __iter__(self):
         return self.depth_first_iter()
@@ -150,31 +311,99 @@ class TaxNode(object):
         ranks = [i for i in self.ranks if i in ranks_represented]
         assert len(ranks_represented) == len(ranks)
 
-        def node_record(node):
+        header = ['tax_id', 'parent_id', 'rank', 'tax_name'] + ranks
+        columns = {rank: i for i, rank in enumerate(header) if i >= 4}
+
+        def node_record(node, lineage):
             parent_id = node.parent.tax_id if node.parent else node.tax_id
-            d = {'tax_id': node.tax_id,
-                 'tax_name': node.name,
-                 'parent_id': parent_id,
-                 'rank': node.rank}
-            l = {i.rank: i.tax_id for i in node.lineage()}
-            d.update(l)
-            return d
+            row = [node.tax_id, parent_id, node.rank, node.name] + [''] * len(ranks)
+            for rank, i in lineage.iteritems():
+                row[columns[rank]] = i.tax_id
+            return row
 
-        header = ['tax_id', 'parent_id', 'rank', 'tax_name'] + ranks
-        w = csv.DictWriter(out_fp, header, quoting=csv.QUOTE_NONNUMERIC,
+        w = csv.writer(out_fp, quoting=csv.QUOTE_NONNUMERIC,
                 lineterminator='\n')
-        w.writeheader()
+        w.writerow(header)
         # All nodes leading to this one
+        lineage = {}
         for i in self.lineage()[:-1]:
-            w.writerow(node_record(i))
-        w.writerows(node_record(i) for i in self)
+            lineage[i.rank] = i
+            w.writerow(node_record(i, lineage))
+        w.writerows(node_record(i, l) for i, l in self.rank_lineage_iter())
 
-    def populate_from_seqinfo(self, seqinfo):
-        """Populate sequence_ids below this node from a seqinfo file object."""
-        for row in csv.DictReader(seqinfo):
-            node = self.index.get(row['tax_id'])
-            if node:
-                node.sequence_ids.add(row['seqname'])
+    def write_columnar(self, out_fp):
+        """
+        Write a columnar taxtable (see :mod:`taxtastic.coltable`) for this
+        node and all descendants, including the lineage leading to this node.
+        """
+        ranks_represented = frozenset(i.rank for i in self) | \
+                            frozenset(i.rank for i in self.lineage())
+        ranks = [i for i in self.ranks if i in ranks_represented]
+
+        def record(node):
+            parent_id = node.parent.tax_id if node.parent else node.tax_id
+            return node.tax_id, parent_id, node.rank, node.name
+
+        # All nodes leading to this one, then this node and its descendants
+        records = [record(i) for i in self.lineage()[:-1]]
+        records.extend(record(i) for i in self)
+        coltable.write(out_fp, ranks, records)
+
+    def populate_from_seqinfo(self, seqinfo, compact=False):
+        """
+        Populate sequence_ids below this node from a seqinfo file object.
+
+        Only the ``seqname`` and ``tax_id`` columns are read. Rows with a
+        tax_id which is not in the tree are skipped; a dictionary mapping
+        each such tax_id to its number of rows is returned, and a single
+        warning summarizes them.
+
+        If *compact* is true, the sequence ids of each node are stored as a
+        tuple (without duplicates) rather than a set, which takes much less
+        memory for large seqinfo files; such nodes' ``sequence_ids`` must not
+        be modified in place. Otherwise sequence ids are added to each node's
+        set as rows are read, and tuples left by an earlier compact call are
+        turned back into sets.
+        """
+        r = csv.reader(seqinfo)
+        headers = next(r)
+        seqname_i, tax_id_i = headers.index('seqname'), headers.index('tax_id')
+
+        index = self.index
+        # Tuples can't be extended in place, so in compact mode the new
+        # seqnames of each node are collected first.
+        pending = collections.defaultdict(list)
+        unknown = collections.Counter()
+        for row in r:
+            tax_id = row[tax_id_i]
+            node = index.get(tax_id)
+            if node is None:
+                if tax_id:
+                    unknown[tax_id] += 1
+            elif compact:
+                pending[node].append(row[seqname_i])
+            else:
+                ids = node._sequence_ids
+                if not isinstance(ids, set):
+                    ids = node._sequence_ids = set(ids or ())
+                ids.add(row[seqname_i])
+
+        while pending:
+            node, seqnames = pending.popitem()
+            seen = set()
+            ids = []
+            for seqname in itertools.chain(node._sequence_ids or (), seqnames):
+                if seqname not in seen:
+                    seen.add(seqname)
+                    ids.append(seqname)
+            node._sequence_ids = tuple(ids)
+
+        if unknown:
+            shown = sorted(unknown)[:10]
+            log.warning('%d sequences with %d tax_ids not in the taxonomy: %s%s',
+                        sum(unknown.values()), len(unknown), ', '.join(shown),
+                        ', ...' if len(unknown) > len(shown) else '')
+        return dict(unknown)
 
     @classmethod
     def from_taxtable(cls, taxtable_fp):
@@ -184,48 +413,241 @@ class TaxNode(object):
         """
         r = csv.reader(taxtable_fp)
         headers = next(r)
-        rows = (collections.OrderedDict(zip(headers, i)) for i in r)
+        tax_id_i, parent_id_i, rank_i, name_i = [headers.index(i)
+                for i in ('tax_id', 'parent_id', 'rank', 'tax_name')]
 
-        row = next(rows)
-        root = cls(rank=row['rank'], tax_id=row['tax_id'], name=row['tax_name'])
+        row = next(r)
+        root = cls(rank=row[rank_i], tax_id=row[tax_id_i], name=row[name_i])
         root.ranks = headers[4:]
-        for row in rows:
-            rank, tax_id, name = [row[i] for i in ('rank', 'tax_id', 'tax_name')]
-            path = filter(None, row.values()[4:])
-            parent = root.path(path[:-1])
-            parent.add_child(cls(rank, tax_id, name=name))
+        index = root.index
+        # The validated lineage columns of each node, by tax_id
+        lineages = {root.tax_id: tuple(filter(None, row[4:]))}
+        for row in r:
+            tax_id, parent_id = row[tax_id_i], row[parent_id_i]
+            # Parents precede their children in a taxtable. The lineage
+            # columns must be those of the parent, followed by this node.
+            path = tuple(filter(None, row[4:]))
+            if parent_id not in index or path[-1:] != (tax_id,) or \
+                    path[:-1] != lineages[parent_id]:
+                raise KeyError(parent_id)
+            lineages[tax_id] = path
+            index[parent_id].add_child(cls(row[rank_i], tax_id, name=row[name_i]))
 
         return root
 
+    @classmethod
+    def from_columnar(cls, fp):
+        """
+        Generate a node from an open handle to a columnar taxtable, as
+        generated by :meth:`write_columnar` or ``taxit taxtable
+        --output-format columnar``
+
+        Nodes are created and linked straight from the typed columns, using
+        the parent row indices rather than looking parents up by tax_id.
+        """
+        table = coltable.read(fp)
+        tax_ids, parents = table.tax_ids, table.parents
+        n = len(tax_ids)
+        roots = [i for i, p in enumerate(parents) if i == p]
+        if len(roots) != 1:
+            raise ValueError(
+                'Expected a single root, found {0}'.format(len(roots)))
+
+        # Every row has a parent, so a row whose parents do not lead to the
+        # root is on a cycle. 0: not yet seen, 1: leads to the root, 2: on
+        # the path being followed.
+        state = bytearray(n)
+        state[roots[0]] = 1
+        for i in xrange(n):
+            path = []
+            j = i
+            while not state[j]:
+                state[j] = 2
+                path.append(j)
+                j = parents[j]
+            if state[j] == 2:
+                raise ValueError('Columnar taxtable contains unreachable nodes')
+            for j in path:
+                state[j] = 1
+        del state
+
+        rank_values, names = table.rank_values, table.names
+        nodes = [cls(rank_values[r], tax_id, name=names[name])
+                 for tax_id, r, name in itertools.izip(
+                     tax_ids, table.rank_codes, table.name_codes)]
+        index = dict(itertools.izip(tax_ids, nodes))
+        if len(index) != n:
+            raise ValueError('Columnar taxtable contains duplicate tax_ids')
+
+        ranks = table.ranks
+        root = nodes[roots[0]]
+        root.ranks = ranks
+        root.index = index
+        for node, p in itertools.izip(nodes, parents):
+            parent = nodes[p]
+            if parent is node:
+                continue
+            node.parent = parent
+            node.ranks = ranks
+            node.index = index
+            children = parent._children
+            if children is None:
+                children = parent._children = set()
+            children.add(node)
+        return root
+
     @classmethod
     def from_taxdb(cls, con, root=None):
         """
         Generate a TaxNode from a taxonomy database
+
+        The whole tree (if *root* is None) is read with a single scan of the
+        nodes table; a subtree is read with a single recursive query.
         """
         cursor = con.cursor()
         if root is None:
-            cursor.execute("SELECT tax_id, rank FROM nodes WHERE tax_id = parent_id")
+            cursor.execute("SELECT tax_id, parent_id, rank FROM nodes WHERE tax_id = parent_id")
         else:
-            cursor.execute("SELECT tax_id, rank FROM nodes WHERE tax_id = ?", [root])
+            cursor.execute("SELECT tax_id, parent_id, rank FROM nodes WHERE tax_id = ?", [root])
 
-        tax_id, rank = cursor.fetchone()
+        tax_id, parent_id, rank = cursor.fetchone()
         root = cls(rank=rank, tax_id=tax_id)
 
-        def add_lineage(parent):
-            cursor.execute("""SELECT tax_id, rank, tax_name
+        if tax_id == parent_id:
+            # Root of the taxonomy: every node is included
+            cursor.execute("""SELECT tax_id, parent_id, rank, tax_name
                     FROM nodes INNER JOIN names USING (tax_id)
-                    WHERE parent_id = :1 and tax_id <> :1
+                    WHERE tax_id <> parent_id
+                        AND names.is_primary = 1
+                    """)
+        else:
+            cursor.execute("""WITH RECURSIVE subtree(tax_id) AS (
+                        SELECT :1
+                        UNION ALL
+                        SELECT nodes.tax_id
+                        FROM nodes JOIN subtree
+                            ON nodes.parent_id = subtree.tax_id
+                        WHERE nodes.tax_id <> nodes.parent_id
+                    )
+                    SELECT tax_id, parent_id, rank, tax_name
+                    FROM subtree
+                        JOIN nodes USING (tax_id)
+                        JOIN names USING (tax_id)
+                    WHERE tax_id <> :1
                         AND names.is_primary = 1
-                    """, [parent.tax_id])
-            for tax_id, rank, name in cursor:
-                node = cls(rank=rank, tax_id=tax_id, name=name)
-                parent.add_child(node)
-            for child in parent.children:
-                add_lineage(child)
-
-        add_lineage(root)
+                    """, [tax_id])
+
+        children = collections.defaultdict(list)
+        for tax_id, parent_id, rank, name in cursor:
+            children[parent_id].append(cls(rank=rank, tax_id=tax_id, name=name))
+        root._add_descendants(children)
         return root
 
+    def _add_descendants(self, children):
+        """
+        Add nodes below this node, parents before children, from *children*,
+        a dictionary mapping the tax_id of a parent to a list of child nodes.
+        """
+        stack = [self]
+        while stack:
+            node = stack.pop()
+            for child in children.get(node.tax_id, ()):
+                node.add_child(child)
+                stack.append(child)
+
+    def lca_index(self):
+        """
+        Build an :class:`LCAIndex` over this node and its descendants.
+        """
+        return LCAIndex(self)
+
+
+class LCAIndex(object):
+    """
+    Index for lowest common ancestor queries on a TaxNode tree.
+
+    Nodes are numbered in pre-order, so that the descendants of a node are
+    numbered ``pre[node] + 1`` through ``pre[node] + size[node] - 1``, and
+    :meth:`is_ancestor` is a comparison of numbers. For the LCA of two nodes
+    ``u`` and ``v`` with ``pre[u] < pre[v]``, the smallest parent number
+    over pre-order positions ``pre[u] + 1 .. pre[v]`` is the number of the
+    LCA; these range minimums are answered in constant time from a sparse
+    table of ``n log n`` integers. The LCA of any set of nodes is the LCA of
+    the nodes with the smallest and largest numbers, so :meth:`mrca` of *k*
+    tax_ids takes O(k).
+
+    The index is a snapshot: it is not updated when the tree changes.
+    """
+
+    def __init__(self, root):
+        tax_ids = []
+        pre = {}
+        # parents[i] is the pre-order number of the parent of node i
+        parents = array.array('i')
+        stack = [(root, 0)]
+        while stack:
+            node, parent = stack.pop()
+            i = len(tax_ids)
+            pre[node.tax_id] = i
+            tax_ids.append(node.tax_id)
+            parents.append(parent)
+            if node._children:
+                stack.extend((child, i) for child in node._children)
+
+        sizes = array.array('i', [1]) * len(tax_ids)
+        for i in xrange(len(tax_ids) - 1, 0, -1):
+            sizes[parents[i]] += sizes[i]
+
+        # table[k][i] = min(parents[i + 1:i + 1 + 2 ** k])
+        table = [parents[1:]]
+        width = 1
+        while 2 * width <= len(table[0]):
+            prev = table[-1]
+            table.append(array.array('i', itertools.imap(
+                min, prev[:len(prev) - width], prev[width:])))
+            width *= 2
+
+        self.tax_ids = tax_ids
+        self.pre = pre
+        self.sizes = sizes
+        self._table = table
+
+    def __len__(self):
+        return len(self.tax_ids)
+
+    def __contains__(self, tax_id):
+        return tax_id in self.pre
+
+    def _lca(self, lo, hi):
+        """
+        LCA of the nodes numbered *lo* and *hi*, where ``lo <= hi``.
+        """
+        if lo == hi:
+            return lo
+        k = (hi - lo).bit_length() - 1
+        row = self._table[k]
+        return min(row[lo], row[hi - (1 << k)])
+
+    def is_ancestor(self, ancestor, tax_id):
+        """
+        Return whether *ancestor* is *tax_id* or lies above it in the tree.
+        """
+        a, b = self.pre[ancestor], self.pre[tax_id]
+        return a <= b < a + self.sizes[a]
+
+    def mrca(self, *tax_ids):
+        """
+        Return the tax_id of the most recent common ancestor of *tax_ids*.
+
+        Raises KeyError if a tax_id is not in the tree, and ValueError if no
+        tax_ids are given.
+        """
+        if not tax_ids:
+            raise ValueError('mrca() requires at least one tax_id')
+        pre = self.pre
+        numbers = [pre[t] for t in tax_ids]
+        return self.tax_ids[self._lca(min(numbers), max(numbers))]
+
 
 def read(fp):
     """
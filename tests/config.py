@@ -10,6 +10,8 @@ import commands
 import shutil
 import tempfile
 
+from taxtastic.taxtable import TaxNode
+
 log = logging
 
 def funcname(idstr):
@@ -64,6 +66,19 @@ def data_path(*args):
 def output_path(*args):
     return os.path.join(outputdir, *args)
 
+def chain_tree(n):
+    """
+    Return the root of a TaxNode tree of *n* nodes in a single chain, with
+    tax_ids '0' (the root) to str(n - 1).
+    """
+    root = node = TaxNode('root', '0')
+    root.ranks = ['root', 'no_rank']
+    for i in xrange(1, n):
+        child = TaxNode('no_rank', str(i))
+        node.add_child(child)
+        node = child
+    return root
+
 @contextlib.contextmanager
 def tempdir(*args, **kwargs):
     try:
@@ -72,6 +87,23 @@ def tempdir(*args, **kwargs):
     finally:
         shutil.rmtree(d)
 
+@contextlib.contextmanager
+def cache_dir():
+    """
+    Point Refpkg.load_db's default cache at a temporary directory, which is
+    yielded and removed afterwards.
+    """
+    old = os.environ.get('TAXTASTIC_CACHE_DIR')
+    with tempdir() as d:
+        os.environ['TAXTASTIC_CACHE_DIR'] = d
+        try:
+            yield d
+        finally:
+            if old is None:
+                del os.environ['TAXTASTIC_CACHE_DIR']
+            else:
+                os.environ['TAXTASTIC_CACHE_DIR'] = old
+
 class OutputRedirectMixin(object):
     def setUp(self):
         self.old_stdout = sys.stdout
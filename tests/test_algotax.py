@@ -1,7 +1,9 @@
 from Bio import Phylo
+from Bio.Phylo.BaseTree import Clade
 from StringIO import StringIO
 import unittest
-from taxtastic import algotax
+from taxtastic import algotax, refpkg
+from . import config
 
 class ColoredTreeTestMixin(object):
     @classmethod
@@ -80,6 +82,16 @@ class AlgotaxWalkTestMixin(ColoredTreeTestMixin):
     def test_walk(self):
         self.assertEqual(len(self.nodeset), self.convex_tree_size)
 
+    def test_walk_pruned(self):
+        # Pruning states while combining children doesn't change the result
+        prune_min = algotax.PRUNE_STATES_MIN
+        algotax.PRUNE_STATES_MIN = 0
+        try:
+            nodes = algotax.walk(self.parsed_tree.root, self.metadata)
+        finally:
+            algotax.PRUNE_STATES_MIN = prune_min
+        self.assertEqual(self.convex_tree_size, len(nodes))
+
 class AlgotaxWalkTest1(AlgotaxWalkTestMixin, unittest.TestCase):
     tree = '((A,A),(B,B))'
     convex_tree_size = 4
@@ -88,6 +100,13 @@ class AlgotaxWalkTest2(AlgotaxWalkTestMixin, unittest.TestCase):
     tree = '((A,B),(A,B))'
     convex_tree_size = 3
 
+    def test_walk_clade(self):
+        clade = self.parsed_tree.root.clades[0]
+        states = algotax.walk(clade, self.metadata)
+        self.assertEqual(set(['A', 'B', None]), set(states))
+        self.assertEqual(set(clade.clades),
+                         states[None][frozenset(['A', 'B'])])
+
 class AlgotaxWalkTest3(AlgotaxWalkTestMixin, unittest.TestCase):
     tree = '(((A,B),(A,B)),(C,C))'
     convex_tree_size = 5
@@ -100,6 +119,81 @@ class AlgotaxWalkTest5(AlgotaxWalkTestMixin, unittest.TestCase):
     tree = '(A,(A,(B,C)))'
     convex_tree_size = 4
 
+class AlgotaxWalkTest6(AlgotaxWalkTestMixin, unittest.TestCase):
+    tree = '((A,B,A),(B,A,C),(C,C,A,B))'
+    convex_tree_size = 6
+
+class AlgotaxWalkTest7(AlgotaxWalkTestMixin, unittest.TestCase):
+    tree = '(A,B,(A,B,C),(C,(A,C)),B)'
+    convex_tree_size = 6
+
+class AlgotaxWalkTest8(AlgotaxWalkTestMixin, unittest.TestCase):
+    tree = '((A,B),(A,B),(A,B),(A,B))'
+    convex_tree_size = 5
+
+class AlgotaxWalkStateCapTest(ColoredTreeTestMixin, unittest.TestCase):
+    tree = '((A,B,A),(B,A,C),(C,C,A,B))'
+
+    def test_walk(self):
+        capped = algotax.walk(self.parsed_tree.root, self.metadata,
+                              max_states=1)
+        self.assertTrue(0 < len(capped) <= 6)
+
+class AlgotaxWalkDeepTest(unittest.TestCase):
+    def test_walk(self):
+        # A caterpillar deeper than the recursion limit, colored A above and
+        # B below, except for one B among the As.
+        n = 5000
+        names = ['A'] * (n // 2) + ['B'] * (n - n // 2)
+        names[10] = 'B'
+        root = cur = Clade()
+        leaves = []
+        for name in names[:-2]:
+            leaf = Clade(name=name)
+            leaves.append(leaf)
+            cur.clades = [leaf, Clade()]
+            cur = cur.clades[1]
+        cur.clades = [Clade(name=name) for name in names[-2:]]
+        leaves.extend(cur.clades)
+        tree = Phylo.BaseTree.Tree(root=root)
+        metadata = algotax.color_clades(tree, {l: l.name for l in leaves})
+        nodes = algotax.walk(root, metadata)
+        self.assertEqual(n - 1, len(nodes))
+        self.assertNotIn(leaves[10], nodes)
+
+class PruneStatesTest(unittest.TestCase):
+    def test_prune_states(self):
+        states = {
+            frozenset(): (1, 'n1'),
+            frozenset('A'): (3, (1, 'n1'), (2, (1, 'n2'), (1, 'n3'))),
+            frozenset('AB'): (2, (1, 'n1'), (1, 'n2')),
+            frozenset('B'): (2, (1, 'n1'), (1, 'n2')),
+            frozenset('BC'): (4, (2, (1, 'n1'), (1, 'n2')),
+                              (2, (1, 'n3'), (1, 'n4'))),
+        }
+        self.assertEqual(
+            set([frozenset(), frozenset('A'), frozenset('B'),
+                 frozenset('BC')]),
+            set(algotax.prune_states(states)))
+        self.assertEqual([frozenset('BC')],
+                         algotax.prune_states(states, max_states=1).keys())
+
+    def test_solution_nodes(self):
+        a = algotax.join_solutions((1, 'n1'), algotax.EMPTY_SOLUTION)
+        b = algotax.join_solutions((1, 'n2'), (1, 'n3'))
+        solution = algotax.join_solutions(a, b)
+        self.assertEqual(3, solution[0])
+        self.assertEqual(set(['n1', 'n2', 'n3']),
+                         algotax.solution_nodes(solution))
+
+    def test_shared_colors(self):
+        self.assertEqual(
+            set('BC'),
+            algotax.shared_colors([set('AB'), set('BC'), set('CD'), set('B')]))
+        self.assertEqual(set(), algotax.shared_colors([set('AB'), set('C')]))
+        self.assertEqual(set(), algotax.shared_colors([]))
+
+
 class RerootingTestMixin(object):
     @classmethod
     def setup_class(cls):
@@ -135,3 +229,29 @@ class RerootingTest3(RerootingTestMixin, unittest.TestCase):
 class RerootingTest4(RerootingTestMixin, unittest.TestCase):
     tree = '((((6,7)4,5)2,3)0,1)'
     root_number = 0
+
+class RerootFromRefpkgTest(unittest.TestCase):
+    def test_reroot_from_rp(self):
+        rp = refpkg.Refpkg(config.data_path('lactobacillus2-0.2.refpkg'),
+                           create=False)
+        rp.load_db(cache=False)
+        name_map = dict(rp.db.execute("SELECT seqname, tax_id FROM sequences"))
+        rank_map = dict(rp.db.execute(
+            "SELECT tax_id, rank_order FROM taxa JOIN ranks USING (rank)"))
+
+        def subrk_min(t):
+            return rank_map[rp.most_recent_common_ancestor(
+                *set(name_map[n.name] for n in t.get_terminals()))]
+
+        with rp.open_resource('tree') as fp:
+            tree = Phylo.read(fp, 'newick')
+        self.assertIs(algotax.reroot(tree.root, subrk_min),
+                      algotax.reroot_from_rp(tree.root, rp))
+
+    def test_reroot_from_rp_no_sequences(self):
+        rp = refpkg.Refpkg(config.data_path('lactobacillus2-0.2.refpkg'),
+                           create=False)
+        rp.load_db(cache=False)
+        tree = Phylo.read(StringIO('(x,y);'), 'newick')
+        self.assertRaises(refpkg.NoAncestor, algotax.reroot_from_rp,
+                          tree.root, rp, ignore_missing_sequences=True)
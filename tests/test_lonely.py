@@ -26,6 +26,19 @@ def test_trees():
     assert t2.descendents.keys() == [1,3,4,5,6,7]
     assert t2.children[0].descendents.keys() == [3,4,5,6,7]
 
+def test_fields():
+    t = Tree(3, rank='genus', tax_name='boris', color='red')
+    assert (t.rank, t.tax_name, t.color) == ('genus', 'boris', 'red')
+    assert t.data == {'color': 'red'}
+    assert Tree(4).rank is None
+    try:
+        t.size
+    except AttributeError:
+        pass
+    else:
+        assert False, 'expected AttributeError'
+
+
 
 taxtable = """"tax_id","parent_id","rank","tax_name","root","below_root","superkingdom","superphylum","phylum","class","subclass","order","below_order","suborder","family","genus","species"
 "1","1","root","root","1","","","","","","","","","","","",""
@@ -85,3 +98,20 @@ def test_lonely_company():
 
 
 
+
+def test_company_batch():
+    engine = create_engine('sqlite:///../testfiles/small_taxonomy.db', echo=False)
+    tax = Taxonomy(engine, ncbi.ranks)
+    tax_ids = ['91061', '1280', None, '1578', '1239', '91061', '1579']
+    siblings = [tax.sibling_of(t) for t in tax_ids]
+    assert lonely_company(tax, tax_ids) == [tax.species_below(t) for t in siblings]
+    expected = []
+    for t in siblings:
+        expected.extend(tax.nary_subtree(t, 2) or [])
+    assert solid_company(tax, tax_ids) == expected
+    try:
+        lonely_company(tax, ['1239', 'nonexistent'])
+    except KeyError:
+        pass
+    else:
+        assert False, 'expected KeyError'
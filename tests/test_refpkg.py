@@ -5,6 +5,9 @@ import json
 import copy
 import os
 import os.path
+import time
+
+import Bio.Phylo
 
 from taxtastic import refpkg, utils
 from . import config
@@ -153,6 +156,28 @@ class TestRefpkg(unittest.TestCase):
             self.assertEqual('2f11faa616fc7f04d7694436b5cca05f',
                              r.file_md5('tree'))
 
+    def test_native_reroot(self):
+        with config.tempdir() as d, config.cache_dir():
+            rpkg = os.path.join(d, 'reroot.refpkg')
+            shutil.copytree(config.data_path('lactobacillus2-0.2.refpkg'), rpkg)
+            r = refpkg.Refpkg(rpkg, create=False)
+            with r.open_resource('tree') as fobj:
+                before = Bio.Phylo.read(fobj, 'newick')
+            r.reroot(native=True)
+            self.assertEqual(r.log(), ['Rerooting refpkg'])
+            with r.open_resource('tree') as fobj:
+                after = Bio.Phylo.read(fobj, 'newick')
+            self.assertEqual(sorted(n.name for n in before.get_terminals()),
+                             sorted(n.name for n in after.get_terminals()))
+            # The new root is the parent of these two leaves, the clade that
+            # the SQL-based MRCA of earlier versions also chose; the rest of
+            # the tree hangs off it as a third child.
+            self.assertEqual(3, len(after.root.clades))
+            self.assertEqual(set(['S000014487', 'S001264844']),
+                             set(c.name for c in after.root.clades
+                                 if c.is_terminal()))
+            self.assertFalse(r.is_invalid())
+
     def test_transaction(self):
         with config.tempdir() as d:
             rpkg = os.path.join(d, 'test.refpkg')
@@ -254,6 +279,86 @@ class TestRefpkg(unittest.TestCase):
             r.update_file('aln_fasta', config.data_path('little.fasta'))
             self.assertTrue(isinstance(r.is_ill_formed(), basestring))
 
+    def test_load_db_cache(self):
+        with config.tempdir() as d:
+            r = refpkg.Refpkg(config.data_path('lactobacillus2-0.2.refpkg'),
+                              create=False)
+            r.load_db(cache_dir=d)
+            expected = list(r.db.execute(
+                "SELECT tax_id, lft, rgt FROM hierarchy ORDER BY tax_id"))
+            self.assertEqual(1, len(os.listdir(d)))
+            mtime = os.path.getmtime(os.path.join(d, os.listdir(d)[0]))
+            r.load_db(cache_dir=d)
+            self.assertEqual(1, len(os.listdir(d)))
+            self.assertEqual(
+                mtime, os.path.getmtime(os.path.join(d, os.listdir(d)[0])))
+            self.assertEqual(expected, list(r.db.execute(
+                "SELECT tax_id, lft, rgt FROM hierarchy ORDER BY tax_id")))
+            r.load_db(cache=False)
+            self.assertEqual(expected, list(r.db.execute(
+                "SELECT tax_id, lft, rgt FROM hierarchy ORDER BY tax_id")))
+
+    def test_load_db_cache_pruned(self):
+        with config.tempdir() as d:
+            def touch(name, mtime):
+                open(os.path.join(d, name), 'w').close()
+                os.utime(os.path.join(d, name), (mtime, mtime))
+            old = ['%032x.db' % i for i in range(3)]
+            for i, name in enumerate(old):
+                touch(name, i + 1)
+            # Files not written by load_db, and a recent temporary file
+            foreign = ['old0.db', 'notes.txt', old[0] + '.bak']
+            for name in foreign:
+                touch(name, 0)
+            recent_tmp = old[0] + 'abc.tmp'
+            touch(recent_tmp, time.time())
+            touch(old[1] + 'def.tmp', 0)
+
+            r = refpkg.Refpkg(config.data_path('lactobacillus2-0.2.refpkg'),
+                              create=False)
+            old_size = refpkg.TAXDB_CACHE_SIZE
+            refpkg.TAXDB_CACHE_SIZE = 2
+            try:
+                r.load_db(cache_dir=d)
+            finally:
+                refpkg.TAXDB_CACHE_SIZE = old_size
+            names = set(os.listdir(d))
+            new = set(n for n in names
+                      if refpkg._CACHE_DB_RE.match(n) and n not in old)
+            self.assertEqual(1, len(new))
+            self.assertEqual(set(foreign + [old[2], recent_tmp]), names - new)
+            self.assertEqual(1, len(r.db.execute(
+                "SELECT * FROM taxa WHERE tax_id = '1578'").fetchall()))
+
+    def test_load_db_cache_incomplete(self):
+        with config.tempdir() as d:
+            r = refpkg.Refpkg(config.data_path('lactobacillus2-0.2.refpkg'),
+                              create=False)
+            r.load_db(cache_dir=d)
+            path = os.path.join(d, os.listdir(d)[0])
+            r.db.close()
+            # As left by a connect racing with a concurrent prune
+            open(path, 'w').close()
+            r.load_db(cache_dir=d)
+            self.assertEqual(1, len(r.db.execute(
+                "SELECT * FROM taxa WHERE tax_id = '1578'").fetchall()))
+            self.assertTrue(os.path.getsize(path) > 0)
+
+    def test_default_cache_dir(self):
+        with config.cache_dir() as d:
+            self.assertEqual(d, refpkg.default_cache_dir())
+
+    def test_most_recent_common_ancestor(self):
+        r = refpkg.Refpkg(config.data_path('lactobacillus2-0.2.refpkg'),
+                          create=False)
+        mrca = r.most_recent_common_ancestor
+        self.assertEqual('1597', mrca('1597'))
+        self.assertEqual('655183', mrca('1582', '1597'))
+        self.assertEqual('1578', mrca('1582', '47770', '1633'))
+        self.assertEqual('2', mrca('562', '1633'))
+        self.assertRaises(refpkg.NoAncestor, mrca, '562', 'unknown')
+        self.assertRaises(refpkg.NoAncestor, mrca)
+
     def test_init_dne(self):
         with config.tempdir() as d:
             rpkg = os.path.join(d, 'test.refpkg')
@@ -7,7 +7,8 @@ import os
 import os.path
 
 from taxtastic import refpkg
-from taxtastic.subcommands import update, create, strip, rollback, rollforward, taxtable, check
+from taxtastic.taxtable import TaxNode
+from taxtastic.subcommands import update, create, strip, rollback, rollforward, taxtable, check, convexify
 
 import config
 from config import OutputRedirectMixin
@@ -190,6 +191,7 @@ class TestTaxtable(OutputRedirectMixin, unittest.TestCase):
                     seq_info = None
                     verbosity = 0
                     out_file = h
+                    output_format = 'csv'
                 self.assertEqual(taxtable.action(_Args()), 1)
 
     def test_seqinfo(self):
@@ -202,12 +204,68 @@ class TestTaxtable(OutputRedirectMixin, unittest.TestCase):
                 seq_info = ifp
                 out_file = tf
                 verbosity = 0
+                output_format = 'csv'
             self.assertEqual(taxtable.action(_Args()), 0)
             # No output check at present
             self.assertTrue(tf.tell() > 0)
 
+    def test_columnar(self):
+        with tempfile.TemporaryFile() as tf, \
+             open(config.data_path('simple_seqinfo.csv')) as ifp:
+            class _Args(object):
+                database_file = config.ncbi_master_db
+                taxids = None
+                taxnames = None
+                seq_info = ifp
+                out_file = tf
+                verbosity = 0
+                output_format = 'columnar'
+            self.assertEqual(taxtable.action(_Args()), 0)
+            tf.seek(0)
+            root = TaxNode.from_columnar(tf)
+            self.assertEqual('1', root.tax_id)
+            self.assertEqual(['1', '131567', '2759'],
+                             [i.tax_id for i in root.get_node('537919').lineage()[:3]])
+
 class TestCheck(OutputRedirectMixin, unittest.TestCase):
     def test_runs(self):
         class _Args(object):
             refpkg = config.data_path('lactobacillus2-0.2.refpkg')
         self.assertEqual(check.action(_Args()), 0)
+
+class TestConvexify(OutputRedirectMixin, unittest.TestCase):
+    def run_action(self, n):
+        with tempfile.TemporaryFile() as out, tempfile.TemporaryFile() as tf, \
+                config.cache_dir():
+            class _Args(object):
+                refpkg = config.data_path('lactobacillus2-0.2.refpkg')
+                ranks = ['species', 'genus']
+                outfile = out
+                timings = tf
+                processes = n
+                max_states = None
+            self.assertEqual(convexify.action(_Args()), 0)
+            out.seek(0)
+            tf.seek(0)
+            return out.read(), tf.read()
+
+    def test_action(self):
+        cut, timings = self.run_action(1)
+        self.assertEqual('rank,seqname,tax_id\r\nspecies,S000014487,1582\r\n',
+                         cut)
+        self.assertEqual(['rank', 'species', 'genus', 'total'],
+                         [line.split(',')[0] for line in timings.splitlines()])
+        # Solving ranks in parallel gives the same result
+        self.assertEqual(cut, self.run_action(2)[0])
+
+    def test_init_worker_deep_tree(self):
+        # A caterpillar deeper than the recursion limit
+        n = 3000
+        newick = '(' * (n - 1) + 'l0' + ''.join(
+            ',l%d)' % i for i in range(1, n)) + ';'
+        with tempfile.NamedTemporaryFile(suffix='.tre') as tf:
+            tf.write(newick)
+            tf.flush()
+            convexify.init_worker(tf.name)
+        self.assertEqual(set('l%d' % i for i in range(n)),
+                         set(convexify._leaves))
@@ -157,6 +157,27 @@ def test_species_below():
         assert t is None or s is None or tax.is_ancestor_of(s, t)
         assert s is None or tax.rank(s) == 'species'
 
+def test_species_below_none():
+    engine = create_engine('sqlite:///../testfiles/small_taxonomy.db', echo=False)
+    tax = Taxonomy(engine, taxtastic.ncbi.ranks)
+    # A genus without species
+    assert tax.species_below('836') is None
+
+def test_species_below_checked():
+    # With debug logging, results are also checked with is_ancestor_of
+    engine = create_engine('sqlite:///../testfiles/small_taxonomy.db', echo=False)
+    tax = Taxonomy(engine, taxtastic.ncbi.ranks)
+    root = logging.getLogger()
+    level = root.level
+    root.setLevel(logging.DEBUG)
+    try:
+        assert tax.species_below('836') is None
+        assert tax.children_of('1239', 2) == ['91061', '186801']
+        s = tax.species_below('1239')
+        assert tax.rank(s) == 'species' and tax.is_ancestor_of(s, '1239')
+    finally:
+        root.setLevel(level)
+
 def test_is_below():
     assert is_below('species', 'family')
     assert is_below('family', 'kingdom')
@@ -171,3 +192,14 @@ def test_nary_subtree():
     t = tax.nary_subtree('1239')
     assert t == ['1280', '372074', '1579', '1580', '37734', '420335', '166485', '166486']
 
+
+def test_lonely_nodes():
+    engine = create_engine('sqlite:///%s' % dbname, echo=False)
+    tax = Taxonomy(engine, taxtastic.ncbi.ranks)
+    nodes = list(tax.lonely_nodes())
+    assert ('537919', 'species', 'Microtus levis') in nodes
+    parents = [tax.parent_id(t) for t, _, _ in nodes]
+    children = engine.execute('SELECT parent_id, COUNT(*) FROM nodes '
+                              'WHERE tax_id != parent_id GROUP BY parent_id')
+    assert set(parents) == set(p for p, n in children if n == 1)
+    assert list(tax.lonely_nodes(['genus'])) == [n for n in nodes if n[1] == 'genus']
@@ -1,9 +1,13 @@
 from cStringIO import StringIO
+import csv
 import os.path
+import pickle
+import sqlite3
 import unittest
 
+from taxtastic import coltable, taxdb
 from taxtastic.taxtable import TaxNode
-from .config import data_path
+from .config import chain_tree, data_path, ncbi_master_db
 
 DN = os.path.dirname(__file__)
 
@@ -26,6 +30,62 @@ class TaxNodeTestCase(unittest.TestCase):
         self.assertEqual(['1', '131567', '2', '1239', '91061', '186826', '1300', '1301', '1303'],
                 [i.tax_id for i in lineage])
 
+    def test_iter_orders(self):
+        seen = set()
+        for node in self.root.depth_first_iter(self_first=False):
+            self.assertTrue(all(c in seen for c in node.children))
+            seen.add(node)
+        self.assertEqual(356, len(seen))
+
+        depths = [len(node.lineage()) for node in self.root.breadth_first_iter()]
+        self.assertEqual(356, len(depths))
+        self.assertEqual(sorted(depths), depths)
+
+    def test_deep_tree(self):
+        root = chain_tree(5000)
+        node = root.get_node('4999')
+        self.assertEqual(5000, sum(1 for _ in root))
+        self.assertEqual(5000, sum(1 for _ in root.depth_first_iter(self_first=False)))
+        self.assertEqual(5000, len(node.lineage()))
+        self.assertIs(node, root.path([str(i) for i in xrange(5000)]))
+
+    def test_lazy_attributes(self):
+        node = TaxNode('species', '9')
+        self.assertIs(node, node.get_node('9'))
+        self.assertTrue(node.is_leaf)
+        self.assertEqual(set(), node.children)
+        node.sequence_ids.add('s1')
+        self.assertEqual(['s1'], list(node.subtree_sequence_ids()))
+        self.assertFalse(hasattr(node, '__dict__'))
+
+    def test_pickle(self):
+        self.root.get_node('1303').sequence_ids.add('s1')
+        for protocol in range(pickle.HIGHEST_PROTOCOL + 1):
+            root = pickle.loads(pickle.dumps(self.root, protocol))
+            self.assertEqual(
+                sorted((n.tax_id, n.rank, n.name) for n in self.root),
+                sorted((n.tax_id, n.rank, n.name) for n in root))
+            node = root.get_node('1303')
+            self.assertIs(root.index, node.index)
+            self.assertEqual(set(['s1']), node.sequence_ids)
+            self.assertEqual('1301', node.parent.tax_id)
+            self.assertEqual(self.root.ranks, root.ranks)
+
+    def test_ancestors_at_rank(self):
+        expected = {}
+        for node in self.root:
+            try:
+                expected[node.tax_id] = node.at_rank('genus')
+            except KeyError:
+                pass
+        self.assertEqual(expected, self.root.ancestors_at_rank('genus'))
+        self.assertEqual({'1303': self.root.get_node('1301')},
+                self.root.get_node('1303').ancestors_at_rank('genus'))
+
+    def test_rank_lineage_iter(self):
+        for node, ranks in self.root.get_node('1239').rank_lineage_iter():
+            self.assertEqual({i.rank: i for i in node.lineage()}, ranks)
+
     def test_write_taxtable(self):
         expected = '''"tax_id","parent_id","rank","tax_name","root","below_root","superkingdom","phylum","class","order","family","genus","species"
 "1","1","root","root","1","","","","","","","",""
@@ -46,8 +106,223 @@ class TaxNodeTestCase(unittest.TestCase):
         self.assertEquals(expected, v)
 
 
+    def test_from_taxtable_invalid_lineage(self):
+        taxtable = ('"tax_id","parent_id","rank","tax_name","root","phylum","genus"\n'
+                    '"1","1","root","root","1","",""\n'
+                    '"2","1","phylum","A","1","2",""\n'
+                    '"3","1","phylum","B","1","3",""\n'
+                    '"4","2","genus","C","1","3","4"\n')
+        self.assertRaises(KeyError, TaxNode.from_taxtable, StringIO(taxtable))
+
+    def test_from_taxtable_invalid_middle_lineage(self):
+        # 5 is under phylum 3, but 4's lineage puts it under phylum 2
+        taxtable = ('"tax_id","parent_id","rank","tax_name","root","phylum","family","genus"\n'
+                    '"1","1","root","root","1","","",""\n'
+                    '"2","1","phylum","A","1","2","",""\n'
+                    '"3","1","phylum","B","1","3","",""\n'
+                    '"5","3","family","D","1","3","5",""\n'
+                    '"4","5","genus","C","1","2","5","4"\n')
+        self.assertRaises(KeyError, TaxNode.from_taxtable, StringIO(taxtable))
+
+    def test_from_taxtable_unknown_parent(self):
+        taxtable = ('"tax_id","parent_id","rank","tax_name","root","phylum","genus"\n'
+                    '"1","1","root","root","1","",""\n'
+                    '"4","2","genus","C","1","2","4"\n'
+                    '"2","1","phylum","A","1","2",""\n')
+        self.assertRaises(KeyError, TaxNode.from_taxtable, StringIO(taxtable))
+
     def test_prune_unrepresented(self):
         self.root.get_node('1303').sequence_ids.add('sequence1')
         self.root.prune_unrepresented()
         self.assertEqual(set(['1', '131567', '2', '1239', '91061', '186826', '1300', '1301', '1303']),
                 set(self.root.index))
+        self.assertEqual(set(self.root.index), set(i.tax_id for i in self.root))
+
+    def test_prune(self):
+        genus = self.root.get_node('1301')
+        self.root.get_node('1300').prune(lambda node: node.tax_id == '1302')
+        self.assertEqual(['1', '131567', '2', '1239', '91061', '186826', '1300', '1301', '1302'],
+                [i.tax_id for i in self.root.get_node('1302').lineage()])
+        self.assertEqual(set(['1301']), set(i.tax_id for i in self.root.get_node('1300').children))
+        self.assertEqual(set(['1302']), set(i.tax_id for i in genus.children))
+        self.assertNotIn('1303', self.root.index)
+        self.assertEqual(set(self.root.index), set(i.tax_id for i in self.root))
+
+    def test_columnar_roundtrip(self):
+        s = StringIO()
+        self.root.write_columnar(s)
+        root = TaxNode.from_columnar(StringIO(s.getvalue()))
+        self.assertEqual(set(self.root.index), set(root.index))
+        self.assertEqual(self.root.ranks, root.ranks)
+        for tax_id, node in self.root.index.iteritems():
+            other = root.get_node(tax_id)
+            self.assertEqual((node.rank, node.name), (other.rank, other.name))
+            self.assertEqual([i.tax_id for i in node.lineage()],
+                             [i.tax_id for i in other.lineage()])
+
+    def test_columnar_cycle(self):
+        table = coltable.ColumnarTaxtable.from_records(
+            ['root', 'genus'], [('1', '1', 'root', 'root'),
+                                ('2', '3', 'genus', 'A'),
+                                ('3', '2', 'genus', 'B')])
+        s = StringIO()
+        table.write(s)
+        self.assertRaises(ValueError, TaxNode.from_columnar,
+                          StringIO(s.getvalue()))
+
+    def test_columnar_rows(self):
+        node = self.root.get_node('1303')
+        csv_out, col_out = StringIO(), StringIO()
+        node.write_taxtable(csv_out)
+        node.write_columnar(col_out)
+        table = coltable.read(StringIO(col_out.getvalue()))
+        expected = list(csv.DictReader(StringIO(csv_out.getvalue())))
+        self.assertEqual(expected, list(table))
+
+    def test_columnar_taxdb(self):
+        s = StringIO()
+        self.root.write_columnar(s)
+        table = coltable.read(StringIO(s.getvalue()))
+        db = taxdb.Taxdb()
+        db.create_tables()
+        db.insert_from_columnar(table)
+        curs = db.cursor()
+        curs.execute("""
+            SELECT parent
+            FROM   parents
+            WHERE  child = '1303'
+        """)
+        self.assertEqual(set(['1', '131567', '2', '1239', '91061', '186826', '1300', '1301', '1303']),
+                set(i for i, in curs))
+
+    def test_taxtable_taxdb(self):
+        s = StringIO()
+        self.root.write_taxtable(s)
+        reader = csv.DictReader(StringIO(s.getvalue()))
+        db = taxdb.Taxdb()
+        db.create_tables()
+        db.insert_from_taxtable(lambda: reader.fieldnames, reader)
+        curs = db.cursor()
+        curs.execute("""
+            SELECT parent
+            FROM   parents
+            WHERE  child = '1303'
+        """)
+        self.assertEqual(set(['1', '131567', '2', '1239', '91061', '186826', '1300', '1301', '1303']),
+                set(i for i, in curs))
+        curs.execute("SELECT COUNT(*) FROM hierarchy")
+        self.assertEqual(len(self.root.index), curs.fetchone()[0])
+
+    def test_populate_from_seqinfo(self):
+        seqinfo = StringIO('seqname,accession,tax_id\n'
+                           's1,a1,1303\ns2,a2,1303\ns3,a3,1301\n'
+                           's4,a4,unknown1\ns5,a5,unknown1\ns6,a6,unknown2\n'
+                           's7,a7,\n')
+        unknown = self.root.populate_from_seqinfo(seqinfo)
+        self.assertEqual({'unknown1': 2, 'unknown2': 1}, unknown)
+        self.assertEqual(set(['s1', 's2']), self.root.get_node('1303').sequence_ids)
+        self.assertEqual(set(['s1', 's2', 's3']),
+                set(self.root.get_node('1301').subtree_sequence_ids()))
+
+    def test_populate_from_seqinfo_compact(self):
+        seqinfo = 'tax_id,seqname\n1303,s1\n1303,s2\n1301,s3\n'
+        self.assertEqual({}, self.root.populate_from_seqinfo(
+            StringIO(seqinfo), compact=True))
+        self.assertEqual(('s1', 's2'), self.root.get_node('1303').sequence_ids)
+        self.root.populate_from_seqinfo(StringIO('tax_id,seqname\n1303,s4\n'),
+                compact=True)
+        self.assertEqual(('s1', 's2', 's4'), self.root.get_node('1303').sequence_ids)
+        self.root.prune_unrepresented()
+        self.assertEqual(['1303'], [n.tax_id for n in self.root.get_node('1301').children])
+
+    def test_populate_from_seqinfo_mixed(self):
+        seqinfo = 'tax_id,seqname\n1303,s1\n1303,s2\n1303,s1\n'
+        self.root.populate_from_seqinfo(StringIO(seqinfo), compact=True)
+        self.assertEqual(('s1', 's2'), self.root.get_node('1303').sequence_ids)
+        self.root.populate_from_seqinfo(StringIO('tax_id,seqname\n1303,s3\n'))
+        self.assertEqual(set(['s1', 's2', 's3']),
+                         self.root.get_node('1303').sequence_ids)
+
+class TaxNodeFromTaxdbTestCase(unittest.TestCase):
+    def setUp(self):
+        self.con = sqlite3.connect(ncbi_master_db)
+
+    def tearDown(self):
+        self.con.close()
+
+    def test_root(self):
+        root = TaxNode.from_taxdb(self.con)
+        self.assertEqual('1', root.tax_id)
+        self.assertEqual(159, len(root.index))
+        self.assertEqual(159, sum(1 for _ in root))
+
+    def test_subtree(self):
+        root = TaxNode.from_taxdb(self.con, '1239')
+        self.assertEqual('phylum', root.rank)
+        self.assertEqual(73, len(root.index))
+        node = root.get_node('1578')
+        self.assertEqual('Lactobacillus', node.name)
+        self.assertEqual(['1239', '91061', '186826', '33958', '1578'],
+                [i.tax_id for i in node.lineage()])
+
+    def test_write_columnar(self):
+        # The root read from the database has no name
+        root = TaxNode.from_taxdb(self.con, '1239')
+        root.ranks = sorted(set(n.rank for n in root))
+        s = StringIO()
+        root.write_columnar(s)
+        other = TaxNode.from_columnar(StringIO(s.getvalue()))
+        self.assertEqual(set(root.index), set(other.index))
+        self.assertEqual('', other.name)
+        self.assertEqual('Lactobacillus', other.get_node('1578').name)
+
+
+class LCAIndexTestCase(unittest.TestCase):
+    def setUp(self):
+        with open(data_path('simple_taxtable.csv')) as fp:
+            self.root = TaxNode.from_taxtable(fp)
+        self.index = self.root.lca_index()
+
+    def naive_mrca(self, *tax_ids):
+        lineages = [self.root.get_node(t).lineage() for t in tax_ids]
+        common = None
+        for nodes in zip(*lineages):
+            if len(set(nodes)) > 1:
+                break
+            common = nodes[0]
+        return common.tax_id
+
+    def test_size(self):
+        self.assertEqual(356, len(self.index))
+        self.assertTrue('1303' in self.index)
+        self.assertFalse('nonexistent' in self.index)
+
+    def test_is_ancestor(self):
+        tax_ids = sorted(self.root.index)
+        for node in self.root:
+            lineage = set(i.tax_id for i in node.lineage())
+            for tax_id in tax_ids[::7]:
+                self.assertEqual(tax_id in lineage,
+                        self.index.is_ancestor(tax_id, node.tax_id))
+
+    def test_mrca_pairs(self):
+        tax_ids = sorted(self.root.index)
+        for a in tax_ids[::5]:
+            for b in tax_ids[::3]:
+                self.assertEqual(self.naive_mrca(a, b), self.index.mrca(a, b))
+
+    def test_mrca(self):
+        self.assertEqual('1303', self.index.mrca('1303'))
+        self.assertEqual('1301', self.index.mrca('1303', '1301'))
+        species = [n.tax_id for n in self.root if n.rank == 'species']
+        self.assertEqual(self.naive_mrca(*species), self.index.mrca(*species))
+        self.assertEqual(self.naive_mrca(*species[:10]),
+                self.index.mrca(*species[:10]))
+        self.assertRaises(KeyError, self.index.mrca, '1303', 'nonexistent')
+        self.assertRaises(ValueError, self.index.mrca)
+
+    def test_chain(self):
+        index = chain_tree(5000).lca_index()
+        self.assertEqual('1234', index.mrca('1234', '4999', '3000'))
+        self.assertTrue(index.is_ancestor('0', '4999'))
+        self.assertFalse(index.is_ancestor('4999', '0'))